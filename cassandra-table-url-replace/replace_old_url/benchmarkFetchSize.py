@@ -0,0 +1,61 @@
+"""Benchmark of table scans for different page sizes and row factories.
+
+Scans 'table_to_update' from cassandraConfigs with the same projection as replaceURL.py and reports rows/sec
+and peak memory for every combination. Point cassandraConfigs at a local Cassandra (for example a docker
+container loaded with a copy of the table) rather than at the production cluster.
+
+Run: python benchmarkFetchSize.py [--fetch-sizes 500,1000,5000,20000] [--row-factories namedtuple,tuple,dict]
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+from cassandra.cluster import Cluster
+from cassandra.query import SimpleStatement, dict_factory
+import cassandraConfigs
+from replaceURL import ROW_FACTORIES, split_fields
+
+BENCHMARK_ROW_FACTORIES = dict(ROW_FACTORIES, dict=dict_factory)
+
+
+def scan(fetch_size, row_factory, limit, results):
+    cluster = Cluster(cassandraConfigs.config['cluster_ip'])
+    session = cluster.connect(cassandraConfigs.config['keyspace'])
+    session.row_factory = BENCHMARK_ROW_FACTORIES[row_factory]
+    table_name = cassandraConfigs.config['table_to_update']
+    field_names = cassandraConfigs.table_shapes.get(table_name, cassandraConfigs.config['fields_to_update'])
+    query = "SELECT {0} from {1}".format(', '.join(split_fields(field_names)), table_name)
+    if limit:
+        query += " LIMIT {}".format(limit)
+
+    start = time.time()
+    rows = 0
+    for row in session.execute(SimpleStatement(query, fetch_size=fetch_size)):
+        rows += 1
+    elapsed = time.time() - start
+    cluster.shutdown()
+    results.put((rows, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fetch-sizes', default='500,1000,5000,20000')
+    parser.add_argument('--row-factories', default='namedtuple,tuple,dict')
+    parser.add_argument('--limit', type=int, default=0, help="Scan at most LIMIT rows, 0 scans the whole table")
+    args = parser.parse_args()
+
+    print("{:>10} {:>12} {:>10} {:>12} {:>14}".format('fetch_size', 'row_factory', 'rows', 'rows/sec', 'max_rss_kb'))
+    for fetch_size in [int(size) for size in args.fetch_sizes.split(',')]:
+        for row_factory in args.row_factories.split(','):
+            # every scan runs in its own process so peak memory isn't carried over between runs
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=scan, args=(fetch_size, row_factory, args.limit, results))
+            process.start()
+            rows, elapsed, max_rss = results.get()
+            process.join()
+            print("{:>10} {:>12} {:>10} {:>12.0f} {:>14}".format(fetch_size, row_factory, rows, rows / elapsed,
+                                                                  max_rss))
+
+
+if __name__ == "__main__":
+    main()
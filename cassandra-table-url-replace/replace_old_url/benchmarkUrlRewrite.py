@@ -0,0 +1,81 @@
+"""Micro-benchmark of the URL rewrite stage on synthetic book_versions values and books thumbnailurls.
+
+Compares the fused single-parse path (urlRewrite.classify_book_value / rewrite_book_value) with the previous
+two-pass parse, where every row was decoded and url-parsed once to match and once more to rewrite.
+
+Run: python benchmarkUrlRewrite.py [--rows 200000] [--mappings 500] [--match-ratio 0.1]
+"""
+import argparse
+import json
+import random
+import time
+from urlparse2 import urlparse
+from urlRewrite import UrlMappingIndex, classify_book_value, rewrite_book_value
+
+
+def generate_samples(rows, mappings, match_ratio):
+    url_mapping = dict(('http://old{}.example.com/content'.format(i), 'https://new{}.example.com/content'.format(i))
+                       for i in range(mappings))
+    old_hosts = list(url_mapping)
+    samples = []
+    for i in range(rows):
+        host = random.choice(old_hosts) if random.random() < match_ratio else 'http://live.example.com/content'
+        url = '{}/api/books/{}/pages/{}'.format(host, i, i % 300)
+        if i % 2:
+            samples.append(('value', json.dumps({'url': url, 'type': 'epub', 'version': i % 7})))
+        else:
+            samples.append(('thumbnailurl', url + '/thumbnail.png'))
+    return url_mapping, samples
+
+
+def legacy_rewrite(field, value, url_mapping):
+    try:
+        book_uri = urlparse(json.loads(value)['url'])
+    except Exception:
+        book_uri = urlparse(value)
+    book_domain = '{uri.scheme}://{uri.netloc}'.format(uri=book_uri) + book_uri.path.split("/api")[0]
+    if not any(book_domain in domain for domain in url_mapping):
+        return None
+
+    try:
+        book_url_json = json.loads(value)
+        book_hostname = book_url_json['url'].split("/api")[0]
+        book_url_json['url'] = book_url_json['url'].replace(book_hostname, url_mapping[book_hostname])
+        return json.dumps(book_url_json)
+    except Exception:
+        book_uri = urlparse(value)
+        book_hostname = '{uri.scheme}://{uri.netloc}'.format(uri=book_uri) + book_uri.path.split("/api")[0]
+        return value.replace(book_hostname, url_mapping[book_hostname])
+
+
+def fused_rewrite(field, value, url_index):
+    parsed_value = classify_book_value(field, value, url_index)
+    return rewrite_book_value(parsed_value) if parsed_value is not None else None
+
+
+def run(name, rewrite, samples, mapping):
+    start = time.time()
+    rewritten = [rewrite(field, value, mapping) for field, value in samples]
+    elapsed = time.time() - start
+    print("{:<8} {:>10.0f} rows/sec  ({:.3f}s, {} rewritten)".format(
+        name, len(samples) / elapsed, elapsed, sum(1 for value in rewritten if value is not None)))
+    return rewritten
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--mappings', type=int, default=500)
+    parser.add_argument('--match-ratio', type=float, default=0.1)
+    args = parser.parse_args()
+
+    random.seed(0)
+    url_mapping, samples = generate_samples(args.rows, args.mappings, args.match_ratio)
+    print("{} rows, {} url mappings, {:.0%} of rows matching".format(args.rows, args.mappings, args.match_ratio))
+    legacy = run('legacy', legacy_rewrite, samples, url_mapping)
+    fused = run('fused', fused_rewrite, samples, UrlMappingIndex(url_mapping))
+    assert legacy == fused, "fused rewrite differs from the legacy rewrite"
+
+
+if __name__ == "__main__":
+    main()
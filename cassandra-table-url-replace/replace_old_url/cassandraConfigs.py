@@ -5,7 +5,38 @@ config = {
     'keyspace': 'bay',
     'fields_to_update': 'value,key,column1',
     'table_to_update': 'book_versions',
-    'logfile': 'migration.db'
+    'logfile': 'migration.db',
+    'scan_mode': 'full',
+    'scan_splits': 256,
+    'scan_workers': 8,
+    'progress_every': 10000,
+    'async_writes': True,
+    'write_window': 128,
+    'write_queue_size': 1000,
+    'write_retries': 3,
+    'batch_updates': False,
+    'batch_max_rows': 50,
+    'batch_max_delay': 1.0,
+    'log_queue_size': 10000,
+    'log_chunk_size': 500,
+    'changeset_chunk_rows': 100000,
+    'fetch_size': 5000,
+    'row_factory': 'namedtuple',
+    'throttle': True,
+    'throttle_min_rate': 100,
+    'throttle_max_rate': 10000,
+    'throttle_target_p99': 0.05,
+    'throttle_status_file': 'throttle.json',
+    'verify_retries': 2,
+    'retry_chunk_size': 500,
+    'retry_concurrency': 64
+}
+
+# UPDATE shape of each table: the column to update followed by its primary key columns.
+# UPDATEs are prepared once per session for these tables, other tables are prepared on first use.
+table_shapes = {
+    'book_versions': 'value,key,column1',
+    'books': 'thumbnailurl,key'
 }
 
 urlToCheck = {
@@ -19,3 +50,37 @@ urlToCheck = {
 # for books table, update the config dict with these values
 # 'fields_to_update': 'thumbnailurl,key',
 # 'table_to_update': 'books',
+
+# to scan the table in parallel, split by token range, update the config dict with these values
+# 'scan_mode': 'token_range',
+# 'scan_splits': 256,    number of token sub-ranges the Murmur3 ring is split into
+# 'scan_workers': 8,     number of token ranges scanned concurrently
+
+# updates are sent with execute_async, with these values controlling the write pipeline
+# 'async_writes': True,       set to False to send one blocking UPDATE per row
+# 'write_window': 128,        maximum number of UPDATEs in flight
+# 'write_queue_size': 1000,   rows buffered between the scanner and the writers before the scanner blocks
+# 'write_retries': 3,         retries per UPDATE before it is logged as failed
+
+# to group rewritten rows sharing a partition key into single-partition UNLOGGED batches, update the config dict
+# 'batch_updates': True,
+# 'batch_max_rows': 50,      a partition is flushed once it buffers this many rows
+# 'batch_max_delay': 1.0,    or once its oldest buffered row is this many seconds old
+
+# results are written to the logfile by a background thread, with these values controlling the write-behind queue
+# 'log_queue_size': 10000,   log records buffered before the migration blocks on the logger
+# 'log_chunk_size': 500,     log records committed per SQLite transaction
+
+# reads are tuned with these values
+# 'fetch_size': 5000,            rows per page fetched from Cassandra
+# 'row_factory': 'namedtuple',   'namedtuple' or 'tuple', rows are always read in table shape order
+
+# scans and updates are throttled by an AIMD controller on coordinator latency, with these values
+# 'throttle': True,                        set to False to run unthrottled
+# 'throttle_min_rate': 100,                lowest allowed requests/sec, also the starting rate and the additive step
+# 'throttle_max_rate': 10000,              highest allowed requests/sec
+# 'throttle_target_p99': 0.05,             p99 latency in seconds above which the rate is halved, as on any timeout
+# 'throttle_status_file': 'throttle.json', current rate, p99 and timeouts, rewritten every second
+
+# --retry-failed reads failed keys from the logfile in chunks of 'retry_chunk_size' keys, each chunk read from
+# Cassandra with 'retry_concurrency' concurrent SELECTs
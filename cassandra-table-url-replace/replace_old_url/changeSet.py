@@ -0,0 +1,57 @@
+import glob
+import gzip
+import json
+import os
+import threading
+
+
+class ChangeSetWriter:
+    """Streams planned URL changes to gzip compressed NDJSON chunks in a directory.
+
+    Every chunk (changeset-00000.ndjson.gz, changeset-00001.ndjson.gz, ...) holds up to `chunk_rows` records of
+    {"table", "field", "key", "column1", "old", "new"}.
+    """
+
+    def __init__(self, directory, chunk_rows):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.lock = threading.Lock()
+        self.chunk = None
+        self.chunk_count = 0
+        self.rows_in_chunk = 0
+        self.rows = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, table_name, field, key, column1, old_value, new_value):
+        record = json.dumps({'table': table_name, 'field': field, 'key': key, 'column1': column1,
+                             'old': old_value, 'new': new_value}, default=str)
+        with self.lock:
+            if self.chunk is None or self.rows_in_chunk >= self.chunk_rows:
+                self.__next_chunk__()
+            self.chunk.write(record + '\n')
+            self.rows_in_chunk += 1
+            self.rows += 1
+
+    def close(self):
+        with self.lock:
+            if self.chunk is not None:
+                self.chunk.close()
+                self.chunk = None
+        print("Wrote {} planned changes to {} chunks in {}".format(self.rows, self.chunk_count, self.directory))
+
+    def __next_chunk__(self):
+        if self.chunk is not None:
+            self.chunk.close()
+        chunk_path = os.path.join(self.directory, 'changeset-{:05d}.ndjson.gz'.format(self.chunk_count))
+        self.chunk = gzip.open(chunk_path, 'wb')
+        self.chunk_count += 1
+        self.rows_in_chunk = 0
+
+
+def read_changeset(directory):
+    """Yield the records of every chunk in a change-set directory, in the order they were written."""
+    for chunk_path in sorted(glob.glob(os.path.join(directory, 'changeset-*.ndjson.gz'))):
+        with gzip.open(chunk_path, 'rb') as chunk:
+            for line in chunk:
+                yield json.loads(line)
@@ -1,8 +1,113 @@
+from cassandra import OperationTimedOut, ReadTimeout, WriteTimeout
 from cassandra.cluster import Cluster
+from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.query import BatchStatement, BatchType, SimpleStatement, tuple_factory
+from cassandra.metadata import Murmur3Token
+from cassandra.policies import DCAwareRoundRobinPolicy, HostDistance, TokenAwarePolicy
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
 import cassandraConfigs
+from changeSet import ChangeSetWriter, read_changeset
+from urlRewrite import UrlMappingIndex, classify_book_value, rewrite_book_value
+import itertools
 import json
-from urlparse2 import urlparse
+import os
+import argparse
+import hashlib
+import Queue
+import signal
 import sqlite3
+import sys
+import threading
+import time
+
+MURMUR3_MIN_TOKEN = -2 ** 63
+MURMUR3_MAX_TOKEN = 2 ** 63 - 1
+
+TokenRange = namedtuple('TokenRange', ['index', 'start', 'end'])
+
+
+def split_token_ring(ring_tokens, splits):
+    """Split the Murmur3 ring into about `splits` (start, end] ranges.
+
+    Sub-ranges never cross a token owned by a node, so every range has a single replica set.
+    """
+    boundaries = sorted(set([MURMUR3_MIN_TOKEN, MURMUR3_MAX_TOKEN] + list(ring_tokens)))
+    ring_width = MURMUR3_MAX_TOKEN - MURMUR3_MIN_TOKEN
+    token_ranges = []
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        pieces = max(1, int(round(float(splits) * (end - start) / ring_width)))
+        step = (end - start) // pieces
+        for piece in range(pieces):
+            piece_start = start + piece * step
+            piece_end = end if piece == pieces - 1 else piece_start + step
+            token_ranges.append(TokenRange(len(token_ranges), piece_start, piece_end))
+    return token_ranges
+
+
+def wait_as_completed(futures):
+    """Yield futures as they complete, like as_completed, but wait a second at a time.
+
+    A wait without a timeout can't be interrupted on python 2, so the main thread would never see SIGTERM.
+    """
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=1)
+        for future in done:
+            yield future
+
+
+def split_fields(fields):
+    if not isinstance(fields, basestring):
+        return list(fields)
+    return [field.strip() for field in fields.split(',')]
+
+
+def book_primary_key(book):
+    """Rows are read in table shape order (column to update, key[, column1]), as tuples or namedtuples."""
+    return book[1], book[2] if len(book) > 2 else None
+
+
+ROW_CLASSES = {}
+
+
+def cached_named_tuple_factory(colnames, rows):
+    """Row factory returning namedtuples (slotted, no per-row dict) whose class is built once per column list.
+
+    The driver's named_tuple_factory builds a new namedtuple class for every page it decodes.
+    """
+    row_class = ROW_CLASSES.get(tuple(colnames))
+    if row_class is None:
+        row_class = ROW_CLASSES.setdefault(tuple(colnames), namedtuple('Row', colnames, rename=True))
+    return map(row_class._make, rows)
+
+
+ROW_FACTORIES = {
+    'namedtuple': cached_named_tuple_factory,
+    'tuple': tuple_factory
+}
+
+
+class TokenRangeAwarePolicy(TokenAwarePolicy):
+    """TokenAwarePolicy that also routes statements carrying a `routing_token` (token range scans)."""
+
+    def make_query_plan(self, working_keyspace=None, query=None):
+        routing_token = getattr(query, 'routing_token', None)
+        keyspace = query.keyspace if query is not None and query.keyspace else working_keyspace
+        token_map = self._cluster_metadata.token_map
+        if routing_token is None or keyspace is None or token_map is None:
+            for host in TokenAwarePolicy.make_query_plan(self, working_keyspace, query):
+                yield host
+            return
+
+        child = self._child_policy
+        replicas = token_map.get_replicas(keyspace, Murmur3Token(routing_token))
+        for replica in replicas:
+            if replica.is_up and child.distance(replica) == HostDistance.LOCAL:
+                yield replica
+        for host in child.make_query_plan(keyspace, query):
+            if host not in replicas or child.distance(host) == HostDistance.REMOTE:
+                yield host
 
 
 class CassandraDataService:
@@ -11,157 +116,1075 @@ class CassandraDataService:
 
     def __init__(self, cluster_ip, keyspace):
         self.establish_connection_to_cluster(cluster_ip, keyspace)
-        self.logger = Logger(cassandraConfigs.config['logfile'])
+        self.logger = Logger(cassandraConfigs.config['logfile'], cassandraConfigs.config.get('log_queue_size', 10000),
+                             cassandraConfigs.config.get('log_chunk_size', 500))
+        self.prepared_statements = {}
+        self.prepare_lock = threading.Lock()
+        self.table_shapes = dict((table_name, split_fields(fields))
+                                 for table_name, fields in cassandraConfigs.table_shapes.items())
+        self.table_shapes[cassandraConfigs.config['table_to_update']] = split_fields(
+            cassandraConfigs.config['fields_to_update'])
+        self.prepare_update_statements()
+        self.throttle = None
+        if cassandraConfigs.config.get('throttle', True):
+            self.throttle = AdaptiveRateLimiter(cassandraConfigs.config.get('throttle_min_rate', 100),
+                                                cassandraConfigs.config.get('throttle_max_rate', 10000),
+                                                cassandraConfigs.config.get('throttle_target_p99', 0.05),
+                                                cassandraConfigs.config.get('throttle_status_file', 'throttle.json'))
+        self.writer = None
+        if cassandraConfigs.config.get('async_writes', True):
+            self.writer = AsyncUpdateWriter(self.session, self.logger,
+                                            cassandraConfigs.config.get('write_window', 128),
+                                            cassandraConfigs.config.get('write_queue_size', 1000),
+                                            cassandraConfigs.config.get('write_retries', 3),
+                                            self.throttle)
 
     def establish_connection_to_cluster(self, cluster_ip, keyspace):
-        self.cluster = Cluster(cluster_ip)
+        self.cluster = Cluster(cluster_ip, load_balancing_policy=TokenRangeAwarePolicy(DCAwareRoundRobinPolicy()))
         self.session = self.cluster.connect(keyspace)
+        self.session.row_factory = ROW_FACTORIES[cassandraConfigs.config.get('row_factory', 'namedtuple')]
+        self.session.default_fetch_size = cassandraConfigs.config.get('fetch_size', 5000)
+        self.keyspace = keyspace
         print self.session
 
+    def __query_fields__(self, table_name, field_names_to_query_array):
+        """Read only the table shape columns, in table shape order, whatever order the fields are given in."""
+        return ', '.join(self.get_table_shape(table_name, split_fields(field_names_to_query_array)[0]))
+
     def get_table_data(self, table_name, field_names_to_query_array, key=None):
-        field_names_to_query_string = ''.join(field_names_to_query_array)
+        field_names_to_query_string = self.__query_fields__(table_name, field_names_to_query_array)
         query = "SELECT {0} from {1}".format(field_names_to_query_string, table_name)
         if key is not None:
             query_input = " WHERE {0}"
             query += query_input.format(key)
 
-        return self.session.execute(query)
+        return self.__execute__(query)
+
+    def get_token_ranges(self, splits):
+        token_map = self.cluster.metadata.token_map
+        ring_tokens = [token.value for token in token_map.ring] if token_map is not None else []
+        return split_token_ring(ring_tokens, splits)
+
+    def get_table_data_in_range(self, table_name, field_names_to_query_array, token_range, paging_state=None):
+        table_metadata = self.cluster.metadata.keyspaces[self.keyspace].tables[table_name]
+        partition_key = ', '.join(column.name for column in table_metadata.partition_key)
+        field_names_to_query_string = self.__query_fields__(table_name, field_names_to_query_array)
+        query = "SELECT {0} from {1} WHERE token({2}) > %s AND token({2}) <= %s".format(
+            field_names_to_query_string, table_name, partition_key)
+
+        statement = SimpleStatement(query, fetch_size=self.session.default_fetch_size)
+        statement.routing_token = token_range.end  # owner of the range end owns the whole range
+        return self.__execute__(statement, (token_range.start, token_range.end), paging_state=paging_state)
 
-    def update_table_data(self, table_name, fields_to_update_list, key, column1=None):
+    def prepare_update_statements(self):
+        for table_name, field_names in self.table_shapes.items():
+            self.__prepare_table_shape__(table_name, field_names)
+
+    def register_table_shape(self, table_name, fields):
+        """Use `fields` (column to update, then primary key columns) for every read and UPDATE of a table."""
+        self.table_shapes[table_name] = split_fields(fields)
+        self.__prepare_table_shape__(table_name, self.table_shapes[table_name])
+
+    def __prepare_table_shape__(self, table_name, field_names):
+        try:
+            self.get_update_statement(table_name, field_names)
+        except Exception as e:
+            print "could not prepare UPDATE for table {}, it will be prepared on first use: {}".format(
+                table_name, repr(e))
+
+    def get_update_statement(self, table_name, field_names):
+        """Return the prepared UPDATE for a table shape: the column to set followed by the primary key columns."""
+        registry_key = (table_name, tuple(field_names))
+        statement = self.prepared_statements.get(registry_key)
+        if statement is None:
+            with self.prepare_lock:
+                statement = self.prepared_statements.get(registry_key)
+                if statement is None:
+                    update_query = "UPDATE {0} SET {1} = ? WHERE {2}".format(
+                        table_name, field_names[0], ' AND '.join('{} = ?'.format(field) for field in field_names[1:]))
+                    statement = self.session.prepare(update_query)
+                    self.prepared_statements[registry_key] = statement
+        return statement
+
+    def get_table_shape(self, table_name, field_to_update=None):
+        """Return the column to update followed by the primary key columns of a table."""
+        if table_name in self.table_shapes:
+            return self.table_shapes[table_name]
+        table_metadata = self.cluster.metadata.keyspaces[self.keyspace].tables[table_name]
+        return [field_to_update] + [column.name for column in table_metadata.primary_key]
+
+    def build_update_statement(self, table_name, fields_to_update_list, key, column1=None):
+        field_names = self.get_table_shape(table_name, fields_to_update_list[0])
+        if len(field_names) > 3:
+            raise ValueError("table {} has more than two primary key columns ({}), only key and column1 are "
+                             "migrated".format(table_name, ', '.join(field_names[1:])))
+        primary_key_values = [key, column1][:len(field_names) - 1]
+        return self.get_update_statement(table_name, field_names).bind([fields_to_update_list[1]] + primary_key_values)
+
+    def update_table_data(self, table_name, fields_to_update_list, key, column1=None, group=None, on_complete=None):
+        """Update one row. The result is logged, or passed to on_complete(key, table, status, message, attempts)."""
 
         print column1
-        if table_name == "book_versions":
-            update_query = """UPDATE {} SET value = '{}' WHERE key='{}' and column1={};""".format(table_name,fields_to_update_list[1], key, int(column1), )
-        elif table_name == "books":
-            update_query = """UPDATE {} SET thumbnailurl = '{}' WHERE key='{}';""".format(table_name, fields_to_update_list[1], key, )
+        update_query = self.build_update_statement(table_name, fields_to_update_list, key, column1)
 
+        if self.writer is not None:
+            self.writer.submit(update_query, key, table_name, on_complete, group)
+            return
+
+        on_complete = on_complete or (lambda key, table, status, message, attempts:
+                                      self.logger.log(key, table, status, message))
         try:
             print "updating database: %s" % update_query
-            self.session.execute(update_query)
-            self.logger.log(key, table_name, 1, update_query)
+            self.__execute__(update_query)
+            on_complete(key, table_name, 1, str(update_query), 1)
         except Exception as e:
             print "database update failed"
             print repr(e)
-            self.logger.log(key, table_name, 0, repr(e))
+            on_complete(key, table_name, 0, repr(e), 1)
+
+    def get_partitions(self, table_name, keys):
+        """Read the partitions of `keys` concurrently, returning a (success, rows or exception) pair per key."""
+        field_names = self.get_table_shape(table_name)
+        registry_key = (table_name, 'select', tuple(field_names))
+        with self.prepare_lock:
+            statement = self.prepared_statements.get(registry_key)
+            if statement is None:
+                statement = self.session.prepare("SELECT {0} from {1} WHERE {2} = ?".format(
+                    ', '.join(field_names), table_name, field_names[1]))
+                self.prepared_statements[registry_key] = statement
+        if self.throttle is not None:
+            for key in keys:
+                self.throttle.acquire()
+        return execute_concurrent_with_args(self.session, statement, [(key,) for key in keys],
+                                            concurrency=cassandraConfigs.config.get('retry_concurrency', 64),
+                                            raise_on_first_error=False)
+
+    def execute_batch(self, batch, table_name, key, on_complete, group=None):
+        if self.writer is not None:
+            self.writer.submit(batch, key, table_name, on_complete, group)
+            return
+
+        try:
+            self.__execute__(batch)
+            on_complete(key, table_name, 1, "batch applied", 1)
+        except Exception as e:
+            print "database batch update failed"
+            print repr(e)
+            on_complete(key, table_name, 0, repr(e), 1)
+
+    def __execute__(self, statement, parameters=None, **kwargs):
+        if self.throttle is None:
+            return self.session.execute(statement, parameters, **kwargs)
+
+        self.throttle.acquire()
+        start_time = time.time()
+        try:
+            result = self.session.execute(statement, parameters, **kwargs)
+        except (OperationTimedOut, ReadTimeout, WriteTimeout):
+            self.throttle.record(time.time() - start_time, timed_out=True)
+            raise
+        self.throttle.record(time.time() - start_time)
+        return result
+
+    def flush_updates(self, group=None):
+        if self.writer is not None:
+            self.writer.flush(group)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.throttle is not None:
+            self.throttle.close()
+        self.logger.close()
+        self.cluster.shutdown()
+
+
+class AdaptiveRateLimiter:
+    """Token bucket limiting Cassandra requests per second, with the rate set by an AIMD controller.
+
+    Every `interval` seconds the p99 of the recorded request latencies is compared with `target_p99`. A p99 above
+    the target, or any timeout, multiplies the rate by `decrease`; otherwise `increase` ops/sec are added. The rate
+    stays within [min_rate, max_rate] and is exported to `status_file` as JSON after every adjustment.
+    """
+
+    def __init__(self, min_rate, max_rate, target_p99, status_file=None, increase=None, decrease=0.5, interval=1.0):
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.target_p99 = target_p99
+        self.status_file = status_file
+        self.increase = increase if increase is not None else self.min_rate
+        self.decrease = decrease
+        self.interval = interval
+        self.rate = self.min_rate
+        self.tokens = 0.0
+        self.refilled_at = time.time()
+        self.adjusted_at = self.refilled_at
+        self.latencies = []
+        self.timeouts = 0
+        self.lock = threading.Lock()
+
+    @property
+    def current_rate(self):
+        return self.rate
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.rate, self.tokens + (now - self.refilled_at) * self.rate)
+                self.refilled_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def record(self, latency, timed_out=False):
+        with self.lock:
+            self.latencies.append(latency)
+            if timed_out:
+                self.timeouts += 1
+            if time.time() - self.adjusted_at >= self.interval:
+                self.__adjust__()
+
+    def close(self):
+        with self.lock:
+            self.__adjust__()
+
+    def __adjust__(self):
+        latencies = sorted(self.latencies)
+        p99 = latencies[int(0.99 * (len(latencies) - 1))] if latencies else None
+        if self.timeouts or (p99 is not None and p99 > self.target_p99):
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+        elif latencies:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+        self.__export__(p99, len(latencies))
+        self.latencies = []
+        self.timeouts = 0
+        self.adjusted_at = time.time()
+
+    def __export__(self, p99, requests):
+        if not self.status_file:
+            return
+        status = {'time': time.time(), 'rate': self.rate, 'p99': p99, 'requests': requests, 'timeouts': self.timeouts,
+                  'min_rate': self.min_rate, 'max_rate': self.max_rate}
+        with open(self.status_file + '.tmp', 'w') as status_file:
+            json.dump(status, status_file)
+        os.rename(self.status_file + '.tmp', self.status_file)
+
+
+class PendingWrite:
+
+    def __init__(self, statement, key, table_name, on_complete, group):
+        self.statement = statement
+        self.key = key
+        self.table_name = table_name
+        self.on_complete = on_complete
+        self.group = group
+        self.attempts = 0
+        self.started = None
+
+
+class AsyncUpdateWriter:
+    """Runs UPDATEs through execute_async with at most `window` statements in flight.
+
+    Writes are queued in a bounded queue, so a scanner that gets ahead of the cluster blocks in submit().
+    Every write ends with exactly one completion callback, after up to `max_retries` retries:
+    on_complete(key, table_name, status, message, attempts). Writes submitted without on_complete are
+    logged to the Logger. Callbacks added with add_completion_callback run for every write.
+    Writes can be tagged with a group (e.g. a token range) so callers can wait for just their own writes.
+    """
+
+    def __init__(self, session, logger, window, queue_size, max_retries, throttle=None):
+        self.session = session
+        self.logger = logger
+        self.max_retries = max_retries
+        self.throttle = throttle
+        self.in_flight = threading.BoundedSemaphore(window)
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.retries = Queue.Queue()
+        self.completion_callbacks = []
+        self.pending = 0
+        self.pending_by_group = {}
+        self.pending_condition = threading.Condition()
+        self.dispatcher = threading.Thread(target=self.__dispatch__, name='async-update-writer')
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def add_completion_callback(self, callback):
+        self.completion_callbacks.append(callback)
+
+    def submit(self, statement, key, table_name, on_complete=None, group=None):
+        with self.pending_condition:
+            self.pending += 1
+            self.pending_by_group[group] = self.pending_by_group.get(group, 0) + 1
+        self.queue.put(PendingWrite(statement, key, table_name, on_complete, group))
+
+    def flush(self, group=None):
+        """Wait until every write, or every write of `group`, has completed."""
+        with self.pending_condition:
+            while (self.pending_by_group.get(group, 0) if group is not None else self.pending) > 0:
+                self.pending_condition.wait(1)
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.dispatcher.join()
+
+    def __dispatch__(self):
+        # retries are dispatched from here rather than from the driver's callback thread, so waiting on the
+        # throttle never blocks the driver's event loop
+        while True:
+            try:
+                write = self.retries.get_nowait()
+            except Queue.Empty:
+                try:
+                    write = self.queue.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+                if write is None:
+                    return
+            self.in_flight.acquire()
+            self.__execute__(write)
+
+    def __execute__(self, write):
+        write.attempts += 1
+        if self.throttle is not None:
+            self.throttle.acquire()
+        write.started = time.time()
+        try:
+            future = self.session.execute_async(write.statement)
+        except Exception as e:
+            self.__on_failure__(e, write)
+            return
+        future.add_callbacks(self.__on_success__, self.__on_failure__, callback_args=(write,), errback_args=(write,))
+
+    def __on_success__(self, rows, write):
+        if self.throttle is not None:
+            self.throttle.record(time.time() - write.started)
+        self.__complete__(write, 1, str(write.statement))
+
+    def __on_failure__(self, exception, write):
+        if self.throttle is not None:
+            self.throttle.record(time.time() - write.started,
+                                 timed_out=isinstance(exception, (OperationTimedOut, WriteTimeout)))
+        if write.attempts <= self.max_retries:
+            print "database update failed, retrying (attempt {}): {}".format(write.attempts, repr(exception))
+            self.in_flight.release()
+            self.retries.put(write)
+            return
+        print "database update failed"
+        print repr(exception)
+        self.__complete__(write, 0, repr(exception))
+
+    def __complete__(self, write, status, message):
+        self.in_flight.release()
+        callbacks = self.completion_callbacks + [write.on_complete or self.__log_result__]
+        for callback in callbacks:
+            try:
+                callback(write.key, write.table_name, status, message, write.attempts)
+            except Exception as e:
+                print "completion callback failed for key {}: {}".format(write.key, repr(e))
+        with self.pending_condition:
+            self.pending -= 1
+            self.pending_by_group[write.group] -= 1
+            if not self.pending_by_group[write.group]:
+                del self.pending_by_group[write.group]
+            self.pending_condition.notify_all()
+
+    def __log_result__(self, key, table_name, status, message, attempts):
+        self.logger.log(key, table_name, status, message)
+
+class PartitionBatcher:
+    """Buffers rewritten rows per partition key and writes them as single-partition UNLOGGED batches.
+
+    A partition is flushed once it holds `max_rows` rows or its oldest row is `max_delay` seconds old.
+    Batches carry the routing key of their partition, so the token aware policy sends them to a replica.
+    """
+
+    def __init__(self, cassandra_data_service, logger, max_rows, max_delay):
+        self.cassandra_data_service = cassandra_data_service
+        self.logger = logger
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.buffers = {}
+        self.lock = threading.Lock()
+        self.batch_ids = itertools.count(1)
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self.__flush_expired__, name='partition-batcher')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def add(self, table_name, fields_to_update_list, key, column1, group=None):
+        statement = self.cassandra_data_service.build_update_statement(table_name, fields_to_update_list, key, column1)
+        with self.lock:
+            buffer = self.buffers.setdefault((table_name, key), {'created': time.time(), 'rows': [], 'group': group})
+            buffer['rows'].append((statement, column1))
+            if len(buffer['rows']) < self.max_rows:
+                return
+            del self.buffers[(table_name, key)]
+        self.__write_batch__(table_name, key, buffer)
+
+    def flush(self, group=None):
+        with self.lock:
+            flushed = dict((partition, buffer) for partition, buffer in self.buffers.items()
+                           if group is None or buffer['group'] == group)
+            for partition in flushed:
+                del self.buffers[partition]
+        for (table_name, key), buffer in flushed.items():
+            self.__write_batch__(table_name, key, buffer)
+
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        self.flush()
+
+    def __flush_expired__(self):
+        while not self.closed.wait(self.max_delay / 2.0):
+            expired_before = time.time() - self.max_delay
+            with self.lock:
+                expired = [(partition, buffer) for partition, buffer in self.buffers.items()
+                           if buffer['created'] <= expired_before]
+                for partition, buffer in expired:
+                    del self.buffers[partition]
+            for (table_name, key), buffer in expired:
+                self.__write_batch__(table_name, key, buffer)
+
+    def __write_batch__(self, table_name, key, buffer):
+        rows = buffer['rows']
+        batch_id = next(self.batch_ids)
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for statement, column1 in rows:
+            batch.add(statement)
+        column1_values = [column1 for statement, column1 in rows]
+
+        def on_complete(key, table_name, status, message, attempts):
+            self.logger.log_batch(batch_id, key, table_name, column1_values, status, message)
+
+        print "writing batch {} of {} rows for key {}".format(batch_id, len(rows), key)
+        self.cassandra_data_service.execute_batch(batch, table_name, key, on_complete, buffer['group'])
+
 
 class EPSMigration:
 
-    def __init__(self, cassandra_configuration):
-        self.cassandra_data_service = CassandraDataService(cassandra_configuration.config['cluster_ip'],
-                                                           cassandra_configuration.config['keyspace'])
-        self.fields_needed_from_db = cassandraConfigs.config['fields_to_update']
-        self.table_to_update = cassandraConfigs.config['table_to_update']
+    def __init__(self, cassandra_configuration, changeset=None, cassandra_data_service=None, table_plan=None):
+        """Migrate the table in cassandraConfigs, or the table of one `table_plan` entry of a migration plan.
+
+        Migrations of a plan share one `cassandra_data_service`; the planned changes of a dry run are written
+        to `changeset` instead of the table.
+        """
+        self.cassandra_data_service = cassandra_data_service or CassandraDataService(
+            cassandra_configuration.config['cluster_ip'], cassandra_configuration.config['keyspace'])
+        table_plan = table_plan or {}
+        self.table_to_update = table_plan.get('table', cassandraConfigs.config['table_to_update'])
+        if 'fields' in table_plan:
+            self.cassandra_data_service.register_table_shape(self.table_to_update, table_plan['fields'])
+        self.fields_needed_from_db = self.cassandra_data_service.get_table_shape(self.table_to_update)
+        self.field_to_update = self.fields_needed_from_db[0]
+        self.scan_mode = table_plan.get('scan_mode', cassandraConfigs.config.get('scan_mode', 'full'))
+        self.scan_splits = table_plan.get('splits', cassandraConfigs.config.get('scan_splits', 256))
+        self.scan_workers = table_plan.get('workers', cassandraConfigs.config.get('scan_workers', 8))
+        self.progress_every = cassandraConfigs.config.get('progress_every', 10000)
+        self.url_index = UrlMappingIndex(cassandraConfigs.urlToCheck)
+        self.changeset = changeset
+        self.stopped = threading.Event()
+        self.batcher = None
+        if cassandraConfigs.config.get('batch_updates', False):
+            self.batcher = PartitionBatcher(self.cassandra_data_service, self.cassandra_data_service.logger,
+                                            cassandraConfigs.config.get('batch_max_rows', 50),
+                                            cassandraConfigs.config.get('batch_max_delay', 1.0))
 
-    def __parse_book_url__(self, book):
+    def __classify_book__(self, book):
 
+        key, column1 = book_primary_key(book)
         if book[0] == None:
-            print("skipping book: {0} because it has no value in one or all of fields".format(book.key))
+            print("skipping book: {0} because it has no value in one or all of fields".format(key))
+            return None
+
+        try:
+            return classify_book_value(self.field_to_update, book[0], self.url_index)
+        except Exception:
+            print("BAD BOOK KEY:{} COLUMN1:{}".format(key, column1))
+            return None
+
+    def __update_book__(self, book, new_url_value, table_to_update, group=None):
+
+        key, column1 = book_primary_key(book)
+        if self.changeset is not None:
+            self.changeset.write(table_to_update, new_url_value[0], key, column1, book[0], new_url_value[1])
             return
+        if self.batcher is not None:
+            self.batcher.add(table_to_update, new_url_value, key, column1, group)
+            return
+        self.cassandra_data_service.update_table_data(table_to_update, new_url_value, key, column1, group)
+        return
+
+    def __process_book__(self, book, group=None):
+        """Rewrite and update a book, returning its new value, or None if it was left as it is."""
+        parsed_value = self.__classify_book__(book)
+        if parsed_value is None:
+            return None
+        try:
+            new_url_value = [parsed_value.field, rewrite_book_value(parsed_value)]
+        except ValueError:
+            print("BAD BOOK KEY:{} COLUMN1:{}".format(*book_primary_key(book)))
+            return None
+        self.__update_book__(book, new_url_value, self.table_to_update, group)
+        return new_url_value[1]
+
+    def __scan_token_range__(self, token_range, range_count, checkpoint=None):
+        progress = RangeProgress(token_range, range_count)
+        paging_state = None
+        if checkpoint is not None:
+            paging_state, progress.scanned, done, digest = checkpoint
+            progress.digest = RangeDigest(digest)
+            if done:
+                progress.report("already done, skipping")
+                return progress
+            progress.report("resuming")
+
+        try:
+            while True:
+                if self.stopped.is_set():
+                    progress.report("stopped after key {}".format(progress.last_key))
+                    return progress
+                page = self.cassandra_data_service.get_table_data_in_range(self.table_to_update,
+                                                                           self.fields_needed_from_db, token_range,
+                                                                           paging_state)
+                for book in page.current_rows:
+                    progress.scanned += 1
+                    progress.last_key = book[1]
+                    new_value = self.__process_book__(book, (self.table_to_update, token_range.index))
+                    if new_value is not None:
+                        progress.updated += 1
+                    progress.digest.add(book[1], book_primary_key(book)[1], new_value if new_value is not None else book[0])
+                    if progress.scanned % self.progress_every == 0:
+                        progress.report("in progress")
+                paging_state = page.paging_state
+                self.__checkpoint__(token_range, paging_state, progress)
+                if paging_state is None:
+                    break
+        except Exception:
+            progress.report("failed after key {}".format(progress.last_key))
+            raise
+
+        progress.report("done")
+        return progress
+
+    def __checkpoint__(self, token_range, paging_state, progress):
+        if self.changeset is not None:
+            return  # a dry run must not mark token ranges done for the real run
+        # only checkpoint a page once every row rewritten from it is written
+        group = (self.table_to_update, token_range.index)
+        if self.batcher is not None:
+            self.batcher.flush(group)
+        self.cassandra_data_service.flush_updates(group)
+        self.cassandra_data_service.logger.save_checkpoint(self.table_to_update, token_range, paging_state,
+                                                           progress.scanned, paging_state is None,
+                                                           progress.digest.hexdigest())
 
-        try: #if field has json values
-            book_url_json = json.loads(book.value)
-            book_uri = urlparse(book_url_json['url'])
-            book_path = book_uri.path.split("/api")
-            book_domain = '{uri.scheme}://{uri.netloc}'.format(uri=book_uri) + book_path[0]
-            return book_domain
-        except: #if field has string values
+    def __token_ranges__(self):
+        if self.scan_mode == 'token_range':
+            return self.cassandra_data_service.get_token_ranges(self.scan_splits), self.scan_workers
+        return [TokenRange(0, MURMUR3_MIN_TOKEN, MURMUR3_MAX_TOKEN)], 1
+
+    def stop(self):
+        """Make the scanners return after the page they are on; their checkpoints let --resume continue."""
+        self.stopped.set()
+
+    def execute(self, resume=False):
+        logger = self.cassandra_data_service.logger
+        token_ranges, scan_workers = self.__token_ranges__()
+
+        if resume:
+            checkpoints = logger.load_checkpoints(self.table_to_update)
+            print("Resuming {} from {} checkpointed token ranges".format(self.table_to_update, len(checkpoints)))
+        else:
+            if self.changeset is None:
+                logger.clear_checkpoints(self.table_to_update)
+            checkpoints = {}
+
+        print("Scanning {} in {} token ranges with {} workers".format(self.table_to_update, len(token_ranges),
+                                                                     scan_workers))
+        executor = ThreadPoolExecutor(max_workers=scan_workers)
+        futures = dict((executor.submit(self.__scan_token_range__, token_range, len(token_ranges),
+                                        checkpoints.get((token_range.start, token_range.end))), token_range)
+                       for token_range in token_ranges)
+        scanned = updated = failed = finished = 0
+        for future in wait_as_completed(futures):
+            token_range = futures[future]
+            finished += 1
             try:
-                book_uri = urlparse(book.thumbnailurl)
-            except:
-                print("BAD BOOK KEY:{} COLUMN1:{}".format(book.key, book.column1))
-                return None
+                progress = future.result()
+                scanned += progress.scanned
+                updated += progress.updated
+            except Exception as e:
+                failed += 1
+                print("token range {} ({}, {}] failed: {}".format(token_range.index, token_range.start,
+                                                                 token_range.end, repr(e)))
+            print("{}: {}/{} token ranges finished, scanned {} rows, updated {}, {} token ranges failed".format(
+                self.table_to_update, finished, len(token_ranges), scanned, updated, failed))
+        executor.shutdown()
+        self.__flush_updates__()
+        print("Scan of {} complete: scanned {} rows, updated {}, {} token ranges failed".format(
+            self.table_to_update, scanned, updated, failed))
+        if self.stopped.is_set():
+            print("Scan of {} was stopped, re-run with --resume to continue from the last checkpoints".format(
+                self.table_to_update))
+        elif failed:
+            print("Re-run with --resume to continue the failed token ranges from their last checkpoint")
 
-            book_path = book_uri.path.split("/api")
-            book_domain = '{uri.scheme}://{uri.netloc}'.format(uri=book_uri) + book_path[0]
-            return book_domain
+    def __verify_token_range__(self, token_range):
+        progress = RangeProgress(token_range, 0)
+        paging_state = None
+        while not self.stopped.is_set():
+            page = self.cassandra_data_service.get_table_data_in_range(self.table_to_update,
+                                                                       self.fields_needed_from_db, token_range,
+                                                                       paging_state)
+            for book in page.current_rows:
+                progress.scanned += 1
+                progress.digest.add(book[1], book_primary_key(book)[1], book[0])
+                if book[0] is not None and self.__classify_book__(book) is not None:
+                    progress.remaining += 1
+            paging_state = page.paging_state
+            if paging_state is None:
+                return progress
+        return progress
 
-    def __replace_url_in_field__(self, book):
+    def __verify_token_ranges__(self, token_ranges, scan_workers):
+        """Rescan token ranges and return those that still hold old URLs or whose digest isn't the recorded one."""
+        checkpoints = self.cassandra_data_service.logger.load_checkpoints(self.table_to_update)
+        executor = ThreadPoolExecutor(max_workers=scan_workers)
+        futures = dict((executor.submit(self.__verify_token_range__, token_range), token_range)
+                       for token_range in token_ranges)
+        mismatched = []
+        for future in wait_as_completed(futures):
+            token_range = futures[future]
+            checkpoint = checkpoints.get((token_range.start, token_range.end))
+            recorded_digest = checkpoint[3] if checkpoint is not None and checkpoint[2] else None
+            try:
+                progress = future.result()
+            except Exception as e:
+                print("verifying token range {} ({}, {}] failed: {}".format(token_range.index, token_range.start,
+                                                                           token_range.end, repr(e)))
+                mismatched.append(token_range)
+                continue
+            digest_matches = recorded_digest is None or recorded_digest == progress.digest.hexdigest()
+            if progress.remaining or not digest_matches:
+                print("token range {} ({}, {}] does not verify: {} of {} rows still have old URLs, digest {}".format(
+                    token_range.index, token_range.start, token_range.end, progress.remaining, progress.scanned,
+                    "matches" if digest_matches else "differs from the migration"))
+                mismatched.append(token_range)
+        executor.shutdown()
+        return sorted(mismatched)
 
-        try: #if field has json values
+    def verify(self):
+        """Check every token range against the digests recorded by the migration, re-migrating the ones that differ.
 
-            #convert to json and parse the string
-            book_url_json = json.loads(book.value)
+        Ranges without a recorded digest are only checked for remaining old URLs.
+        """
+        token_ranges, scan_workers = self.__token_ranges__()
+        verify_retries = cassandraConfigs.config.get('verify_retries', 2)
+        print("Verifying {} in {} token ranges with {} workers".format(self.table_to_update, len(token_ranges),
+                                                                      scan_workers))
+        mismatched = self.__verify_token_ranges__(token_ranges, scan_workers)
+        for attempt in range(verify_retries):
+            if not mismatched or self.stopped.is_set():
+                break
+            print("Re-migrating {} token ranges of {} that did not verify (attempt {} of {})".format(
+                len(mismatched), self.table_to_update, attempt + 1, verify_retries))
+            executor = ThreadPoolExecutor(max_workers=scan_workers)
+            for future in [executor.submit(self.__scan_token_range__, token_range, len(token_ranges))
+                           for token_range in mismatched]:
+                try:
+                    future.result()
+                except Exception as e:
+                    print("re-migrating token range failed: {}".format(repr(e)))
+            executor.shutdown()
+            self.__flush_updates__()
+            mismatched = self.__verify_token_ranges__(mismatched, scan_workers)
 
-            print("The field's value is JSON")
-            book_url_string = book_url_json['url']
+        if mismatched:
+            print("Verification of {} failed: {} token ranges still differ: {}".format(
+                self.table_to_update, len(mismatched),
+                ', '.join('({}, {}]'.format(token_range.start, token_range.end) for token_range in mismatched)))
+        else:
+            print("Verification of {} passed: no old URLs remain and every recorded digest matches".format(
+                self.table_to_update))
+        return not mismatched
 
-            #replace hostname to the new hostname and generate new fully qualified URL
-            book_hostname = book_url_string.split("/api")
-            book_url_string = book_url_string.replace(book_hostname[0], cassandraConfigs.urlToCheck[book_hostname[0]])
+    def retry_failed(self):
+        """Re-migrate the keys logged with status 0 for this table, reading them by key instead of scanning.
 
-            #update json with new fully qualified URL
-            book_url_json['url'] = book_url_string
+        The failed rows in the results table are updated in place with the outcome of the retry.
+        """
+        logger = self.cassandra_data_service.logger
+        retried = unreadable = 0
+        for failed_keys in logger.failed_keys(self.table_to_update,
+                                              cassandraConfigs.config.get('retry_chunk_size', 500)):
+            if self.stopped.is_set():
+                print("Retry of {} stopped".format(self.table_to_update))
+                break
+            partitions = self.cassandra_data_service.get_partitions(self.table_to_update,
+                                                                    [key for key, rowids in failed_keys])
+            for (key, rowids), (success, rows) in zip(failed_keys, partitions):
+                if not success:
+                    print("reading failed key {} of {} failed: {}".format(key, self.table_to_update, repr(rows)))
+                    unreadable += 1
+                    continue
+                self.__retry_partition__(key, rowids, rows)
+                retried += 1
+            print("Retried {} failed keys of {}".format(retried, self.table_to_update))
+        self.__flush_updates__()
+        logger.flush()
+        print("Retry of {} complete: retried {} failed keys, {} keys could not be read".format(
+            self.table_to_update, retried, unreadable))
 
-            #return back the value as string to update in the table
-            return [book._fields[0], (json.dumps(book_url_json))]
+    def __retry_partition__(self, key, rowids, rows):
+        retried_key = RetriedKey(self.cassandra_data_service.logger, rowids)
+        for book in rows:
+            parsed_value = self.__classify_book__(book)
+            if parsed_value is None:
+                continue
+            try:
+                new_value = rewrite_book_value(parsed_value)
+            except ValueError:
+                retried_key.complete(key, self.table_to_update, 0, "BAD BOOK COLUMN1:{}".format(
+                    book_primary_key(book)[1]), 1, expected=False)
+                continue
+            retried_key.expect()
+            key, column1 = book_primary_key(book)
+            self.cassandra_data_service.update_table_data(self.table_to_update, [parsed_value.field, new_value], key,
+                                                          column1, on_complete=retried_key.complete)
+        retried_key.submitted()
 
-        except: #if field has string values
+    def apply_changeset(self, changeset_directory):
+        print("Applying change-set {}".format(changeset_directory))
+        applied = 0
+        for change in read_changeset(changeset_directory):
+            new_url_value = [change['field'], change['new']]
+            if self.batcher is not None:
+                self.batcher.add(change['table'], new_url_value, change['key'], change['column1'])
+            else:
+                self.cassandra_data_service.update_table_data(change['table'], new_url_value, change['key'],
+                                                              change['column1'])
+            applied += 1
+            if applied % self.progress_every == 0:
+                print("Applied {} changes".format(applied))
+        self.__flush_updates__()
+        print("Change-set applied: {} changes".format(applied))
 
-            book_url_string = book.thumbnailurl
+    def __flush_updates__(self):
+        if self.batcher is not None:
+            self.batcher.flush()
+        self.cassandra_data_service.flush_updates()
 
-            book_uri = urlparse(book.thumbnailurl)
-            book_path = book_uri.path.split("/api")
-            book_hostname = '{uri.scheme}://{uri.netloc}'.format(uri=book_uri) + book_path[0]
+    def close(self):
+        """Stop the batch flusher, writing the rows still buffered. Call before closing the data service."""
+        if self.batcher is not None:
+            self.batcher.close()
 
-            print("The field value is String")
-            book_url_string = book_url_string.replace(book_hostname, cassandraConfigs.urlToCheck[book_hostname])
 
-            return [book._fields[0], book_url_string]
+class RangeProgress:
 
+    def __init__(self, token_range, range_count):
+        self.token_range = token_range
+        self.range_count = range_count
+        self.scanned = 0
+        self.updated = 0
+        self.remaining = 0
+        self.last_key = None
+        self.digest = RangeDigest()
 
+    def report(self, state):
+        print("token range {}/{} ({}, {}] {}: scanned {} rows, updated {}".format(
+            self.token_range.index + 1, self.range_count, self.token_range.start, self.token_range.end, state,
+            self.scanned, self.updated))
 
 
-    def __update_book__(self, book, table_to_update):
+class RetriedKey:
+    """Collects the outcome of every UPDATE of a retried key and writes it over the key's failed log rows."""
 
-        new_url_value = self.__replace_url_in_field__(book)
-        self.cassandra_data_service.update_table_data(table_to_update, new_url_value, book.key, book.column1 if hasattr(book, 'column1') else None)
-        return
+    def __init__(self, logger, rowids):
+        self.logger = logger
+        self.rowids = rowids
+        self.lock = threading.Lock()
+        self.pending = 1  # released by submitted()
+        self.status = 1
+        self.messages = []
 
-    def __should_update_book_domain__(self, book_domain):
+    def expect(self):
+        with self.lock:
+            self.pending += 1
 
-        if book_domain == None:
-            return False
+    def complete(self, key, table_name, status, message, attempts, expected=True):
+        with self.lock:
+            self.status = min(self.status, int(status))
+            self.messages.append("retried: {}".format(message))
+            if expected:
+                self.pending -= 1
+            done = not self.pending
+        if done:
+            self.__log__()
 
-        for domains_to_be_replaced in cassandraConfigs.urlToCheck:
-            if book_domain in domains_to_be_replaced:
-                return True
+    def submitted(self):
+        with self.lock:
+            self.pending -= 1
+            done = not self.pending
+        if done:
+            self.__log__()
 
-        return False
+    def __log__(self):
+        message = '; '.join(self.messages) or "retried: no old URL left"
+        self.logger.update_results(self.rowids, self.status, message)
 
-    def execute(self):
-        table_data = self.cassandra_data_service.get_table_data(self.table_to_update, self.fields_needed_from_db)
 
-        try:
-            for book in table_data:
-                book_domain = self.__parse_book_url__(book)
-                if self.__should_update_book_domain__(book_domain):
-                    self.__update_book__(book, self.table_to_update)
-                print (book.key)
+class RangeDigest:
+    """Order independent digest of the (key, column1, value) rows of a token range.
 
-        except Exception as e:
-            print(e)
+    The digest is the sum of the md5 of every row modulo 2**128, so a range read page by page, or resumed from a
+    checkpoint, gets the same digest as a range read in one go.
+    """
+
+    def __init__(self, hexdigest=None):
+        self.value = int(hexdigest, 16) if hexdigest else 0
+
+    def add(self, key, column1, value):
+        row = u'{}\x00{}\x00{}'.format(key, column1, value if value is not None else u'')
+        self.value = (self.value + int(hashlib.md5(row.encode('utf-8')).hexdigest(), 16)) % 2 ** 128
+
+    def hexdigest(self):
+        return '{:032x}'.format(self.value)
 
 
 class Logger:
-    def __init__(self, dbfile):
+    """Write-behind SQLite log of migration results and checkpoints.
+
+    Writes are queued and a background thread applies them in chunks with executemany, one transaction per
+    chunk, on a WAL mode database. Queued writes are applied in order; flush() waits for them and close()
+    flushes before stopping the thread.
+    """
+
+    def __init__(self, dbfile, queue_size=10000, chunk_size=500):
+        self.dbfile = dbfile
+        self.chunk_size = chunk_size
         self.conn = self.__initdb__(dbfile)
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.writer = threading.Thread(target=self.__write_behind__, name='logger-write-behind')
+        self.writer.daemon = True
+        self.writer.start()
 
     def __initdb__(self, dbfile):
-        conn = sqlite3.connect(dbfile)
+        conn = sqlite3.connect(dbfile, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL;")
         with conn:
             conn.execute("CREATE TABLE IF NOT EXISTS results (key text, tablename text, status text, message text);")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_tablename_status ON results (tablename, status);")
+            conn.execute("CREATE TABLE IF NOT EXISTS checkpoints (tablename text, range_start integer, "
+                         "range_end integer, paging_state blob, scanned integer, done integer, "
+                         "PRIMARY KEY (tablename, range_start, range_end));")
+            conn.execute("CREATE TABLE IF NOT EXISTS range_digests (tablename text, range_start integer, "
+                         "range_end integer, digest text, PRIMARY KEY (tablename, range_start, range_end));")
+            conn.execute("CREATE TABLE IF NOT EXISTS batches (batch_id integer, key text, tablename text, rows integer, "
+                         "status text, message text);")
 
         return conn
 
+    def __write_behind__(self):
+        conn = sqlite3.connect(self.dbfile)
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        stopped = False
+        while not stopped:
+            chunk = [self.queue.get()]
+            while len(chunk) < self.chunk_size:
+                try:
+                    chunk.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            statements = []
+            flushed = []
+            for item in chunk:
+                if item is None:
+                    stopped = True
+                elif item[0] is None:
+                    flushed.append(item[1])
+                elif statements and statements[-1][0] == item[0]:
+                    statements[-1][1].append(item[1])
+                else:
+                    statements.append((item[0], [item[1]]))
+
+            try:
+                with conn:
+                    for sql, parameters in statements:
+                        conn.executemany(sql, parameters)
+            except Exception as e:
+                print "writing {} log records failed: {}".format(sum(len(p) for sql, p in statements), repr(e))
+            for event in flushed:
+                event.set()
+        conn.close()
+
+    def __write__(self, sql, parameters):
+        self.queue.put((sql, parameters))
+
+    def flush(self):
+        if not self.writer.is_alive():
+            return
+        flushed = threading.Event()
+        self.queue.put((None, flushed))
+        flushed.wait()
+
+    def close(self):
+        if not self.writer.is_alive():
+            return
+        self.queue.put(None)
+        self.writer.join()
+        self.conn.close()
+
     def log(self, key, table, status, message):
         print "logging key %s from table %s" % (key, table)
-        with self.conn:
-            self.conn.execute("insert into results(key, tablename, status, message) values(?,?,?,?)", (key,table,status,message))
+        self.__write__("insert into results(key, tablename, status, message) values(?,?,?,?)", (key,table,status,message))
+
+    def log_batch(self, batch_id, key, table, column1_values, status, message):
+        print "logging batch %s of key %s from table %s" % (batch_id, key, table)
+        self.__write__("insert into batches(batch_id, key, tablename, rows, status, message) values(?,?,?,?,?,?)",
+                       (batch_id, key, table, len(column1_values), status, message))
+        for column1 in column1_values:
+            self.__write__("insert into results(key, tablename, status, message) values(?,?,?,?)",
+                           (key, table, status, "batch {} column1={}: {}".format(batch_id, column1, message)))
+
+    def failed_keys(self, table, chunk_size):
+        """Yield lists of up to chunk_size (key, rowids) pairs of the keys of a table logged with status 0."""
+        self.flush()
+        conn = sqlite3.connect(self.dbfile)
+        try:
+            cursor = conn.execute("select key, group_concat(rowid) from results where tablename = ? and status = '0' "
+                                  "group by key", (table,))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                yield [(key, [int(rowid) for rowid in rowids.split(',')]) for key, rowids in rows]
+        finally:
+            conn.close()
+
+    def update_results(self, rowids, status, message):
+        for rowid in rowids:
+            self.__write__("update results set status = ?, message = ? where rowid = ?", (status, message, rowid))
 
+    def save_checkpoint(self, table, token_range, paging_state, scanned, done, digest):
+        self.__write__("insert or replace into checkpoints(tablename, range_start, range_end, paging_state, "
+                       "scanned, done) values(?,?,?,?,?,?)",
+                       (table, token_range.start, token_range.end,
+                        sqlite3.Binary(paging_state) if paging_state is not None else None, scanned, int(done)))
+        self.__write__("insert or replace into range_digests(tablename, range_start, range_end, digest) "
+                       "values(?,?,?,?)", (table, token_range.start, token_range.end, digest))
+
+    def load_checkpoints(self, table):
+        """Return {(range_start, range_end): (paging_state, scanned, done, digest)} for a table."""
+        self.flush()
+        with self.lock:
+            rows = self.conn.execute("select c.range_start, c.range_end, c.paging_state, c.scanned, c.done, d.digest "
+                                     "from checkpoints c left join range_digests d using (tablename, range_start, "
+                                     "range_end) where c.tablename = ?", (table,)).fetchall()
+        return dict(((start, end), (str(paging_state) if paging_state is not None else None, scanned, bool(done),
+                                    digest))
+                    for start, end, paging_state, scanned, done, digest in rows)
+
+    def clear_checkpoints(self, table):
+        self.__write__("delete from checkpoints where tablename = ?", (table,))
+        self.__write__("delete from range_digests where tablename = ?", (table,))
+
+
+def load_migration_plan(plan_file):
+    """Read a JSON migration plan: {"tables": [{"table": ..., "fields": ..., "workers": ..., "splits": ...}]}.
+
+    'fields' is the column to update followed by the primary key columns (a key and at most one clustering
+    column) and can be left out for tables in cassandraConfigs.table_shapes. 'workers', 'splits' and 'scan_mode'
+    default to the values in cassandraConfigs.
+    """
+    with open(plan_file) as plan:
+        table_plans = json.load(plan)['tables']
+    for table_plan in table_plans:
+        if 'table' not in table_plan:
+            raise ValueError("every table in migration plan {} needs a 'table' name".format(plan_file))
+        if 'fields' not in table_plan and table_plan['table'] not in cassandraConfigs.table_shapes:
+            raise ValueError("table {} in migration plan {} needs 'fields'".format(table_plan['table'], plan_file))
+        fields = split_fields(table_plan.get('fields', cassandraConfigs.table_shapes.get(table_plan['table'])))
+        if not 2 <= len(fields) <= 3:
+            raise ValueError("table {} in migration plan {} has fields {}: the column to update must be followed "
+                             "by one key column and at most one clustering column".format(
+                                 table_plan['table'], plan_file, ', '.join(fields)))
+    return table_plans
+
+
+def execute_migrations(migrations, resume=False, verify=False, retry_failed=False):
+    """Run, verify or retry the migrations of a plan concurrently, each table with its own pool of scan workers."""
+    executor = ThreadPoolExecutor(max_workers=len(migrations))
+    futures = {}
+    try:
+        for migration in migrations:
+            if verify:
+                futures[executor.submit(migration.verify)] = migration
+            elif retry_failed:
+                futures[executor.submit(migration.retry_failed)] = migration
+            else:
+                futures[executor.submit(migration.execute, resume)] = migration
+        for future in wait_as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print("migration of {} failed: {}".format(futures[future].table_to_update, repr(e)))
+    except BaseException:
+        # e.g. SystemExit from SIGTERM: the scanners must stop submitting before the writers are closed
+        for migration in migrations:
+            migration.stop()
+        raise
+    finally:
+        executor.shutdown()
 
 
 def main():
-    EPSMigration(cassandraConfigs).execute()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue a previous run from the token range checkpoints saved in the log database")
+    parser.add_argument('--dry-run', metavar='CHANGESET_DIR',
+                        help="Scan and rewrite without updating, streaming the planned changes to CHANGESET_DIR")
+    parser.add_argument('--apply-changeset', metavar='CHANGESET_DIR',
+                        help="Apply the changes planned by a previous --dry-run without scanning the table")
+    parser.add_argument('--verify', action='store_true',
+                        help="Rescan the migrated table(s), re-migrating token ranges that still hold old URLs or "
+                             "whose digest differs from the one recorded by the migration")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="Re-migrate only the keys logged as failed (status 0), updating their log rows in place")
+    parser.add_argument('--plan', metavar='PLAN_FILE',
+                        help="Migrate every table of a JSON migration plan concurrently instead of 'table_to_update'")
+    args = parser.parse_args()
+    if len([mode for mode in (args.dry_run, args.apply_changeset, args.verify, args.retry_failed) if mode]) > 1:
+        parser.error("--dry-run, --apply-changeset, --verify and --retry-failed can't be used together")
+
+    # turn SIGTERM into SystemExit so pending updates and log records are flushed before exiting
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    cassandra_data_service = CassandraDataService(cassandraConfigs.config['cluster_ip'],
+                                                  cassandraConfigs.config['keyspace'])
+    changeset = None
+    if args.dry_run:
+        changeset = ChangeSetWriter(args.dry_run, cassandraConfigs.config.get('changeset_chunk_rows', 100000))
+    table_plans = load_migration_plan(args.plan) if args.plan else [None]
+    migrations = [EPSMigration(cassandraConfigs, changeset, cassandra_data_service, table_plan)
+                  for table_plan in table_plans]
+    try:
+        if args.apply_changeset:
+            migrations[0].apply_changeset(args.apply_changeset)
+        else:
+            execute_migrations(migrations, resume=args.resume, verify=args.verify, retry_failed=args.retry_failed)
+    finally:
+        if changeset is not None:
+            changeset.close()
+        for migration in migrations:
+            migration.close()
+        cassandra_data_service.close()
 
 
 if __name__ == "__main__":
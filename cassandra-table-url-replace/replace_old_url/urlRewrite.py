@@ -0,0 +1,122 @@
+import json
+import re
+from urlparse2 import urlparse
+
+JSON_URL_PATTERN = re.compile(r'"url"\s*:\s*"([^"\\]*)"')
+
+
+class UrlMappingIndex:
+    """Compiled lookup of the urlToCheck mappings.
+
+    Old URLs are keyed by scheme://netloc/path (scheme and netloc lower-cased, no trailing slash) in a dict
+    for exact matches. Every mapping is also stored in a trie of path segments per scheme and netloc, so a
+    URL below a mapped path prefix matches its longest mapped prefix. A lookup costs one dict access, plus
+    one trie walk over the URL's path segments when there is no exact match.
+    """
+
+    def __init__(self, url_mapping):
+        self.exact = {}
+        self.trie = {}
+        for old_url, new_url in url_mapping.items():
+            self.add(old_url, new_url)
+
+    def add(self, old_url, new_url):
+        scheme, netloc, segments = split_domain(old_url)
+        prefix = join_domain(scheme, netloc, segments)
+        self.exact[prefix] = (prefix, new_url)
+
+        node = self.trie.setdefault((scheme, netloc), {})
+        for segment in segments:
+            node = node.setdefault(segment, {})
+        node[None] = (prefix, new_url)
+
+    def match(self, book_domain):
+        """Return (old_prefix, new_url) for the longest mapped prefix of book_domain, or None.
+
+        old_prefix is normalized, but has the same length as the part of book_domain it matched.
+        """
+        if book_domain is None:
+            return None
+        scheme, netloc, segments = split_domain(book_domain)
+        mapping = self.exact.get(join_domain(scheme, netloc, segments))
+        if mapping is not None:
+            return mapping
+
+        node = self.trie.get((scheme, netloc))
+        if node is None:
+            return None
+        mapping = node.get(None)
+        for segment in segments:
+            node = node.get(segment)
+            if node is None:
+                break
+            mapping = node.get(None, mapping)
+        return mapping
+
+
+def split_domain(url):
+    scheme, separator, rest = url.partition('://')
+    if not separator:
+        scheme, rest = '', url
+    netloc, _, path = rest.partition('/')
+    path = path.rstrip('/')
+    segments = path.split('/') if path else []
+    return scheme.lower(), netloc.lower(), segments
+
+
+def join_domain(scheme, netloc, segments):
+    prefix = '{}://{}'.format(scheme, netloc) if scheme else netloc
+    return '/'.join([prefix] + segments)
+
+
+class ParsedBookValue(object):
+    """A book field classified and parsed once, handed from matching to rewriting."""
+    __slots__ = ('field', 'raw_value', 'is_json', 'url', 'book_domain', 'mapping')
+
+    def __init__(self, field, raw_value, is_json, url, book_domain, mapping):
+        self.field = field
+        self.raw_value = raw_value
+        self.is_json = is_json
+        self.url = url
+        self.book_domain = book_domain
+        self.mapping = mapping
+
+
+def book_domain_of(url):
+    book_uri = urlparse(url)
+    return '{uri.scheme}://{uri.netloc}'.format(uri=book_uri) + book_uri.path.split("/api")[0]
+
+
+def classify_book_value(field, raw_value, url_index):
+    """Parse a field value once and match it against url_index.
+
+    Returns a ParsedBookValue for values that have to be rewritten and None for everything else. A JSON value
+    whose only "url" key holds no escape sequences is matched straight from the text, so it is only decoded
+    when it has to be rewritten. Raises ValueError for a JSON value without a url.
+    """
+    is_json = raw_value.lstrip().startswith('{')
+    if not is_json:
+        url = raw_value
+    else:
+        url_match = JSON_URL_PATTERN.search(raw_value) if raw_value.count('"url"') == 1 else None
+        url = url_match.group(1) if url_match else json.loads(raw_value)['url']
+
+    book_domain = book_domain_of(url)
+    mapping = url_index.match(book_domain)
+    if mapping is None:
+        return None
+    return ParsedBookValue(field, raw_value, is_json, url, book_domain, mapping)
+
+
+def rewrite_book_value(parsed):
+    """Return the new value of a classified field, with its old URL prefix replaced."""
+    old_prefix, new_url = parsed.mapping
+    book_url_string = parsed.url.replace(parsed.book_domain[:len(old_prefix)], new_url)
+    if not parsed.is_json:
+        return book_url_string
+
+    book_url_json = json.loads(parsed.raw_value)
+    if book_url_json.get('url') != parsed.url:
+        raise ValueError("url is not a top-level key of the value")
+    book_url_json['url'] = book_url_string
+    return json.dumps(book_url_json)
@@ -0,0 +1,104 @@
+"""Benchmark of collapsing failed file paths into the folders remigrate mode re-syncs.
+
+Compares FailedPathTrie from rfsync.py with the previous dict-of-dicts NodeTree on a synthetic FAILED_LOGS.csv
+sized list of paths, reporting the build and collapse time of each.
+
+Run: python benchmarkFailedPaths.py [--paths 1000000] [--granularity directory]
+"""
+import argparse
+import os
+import random
+import time
+from rfsync import FailedPathTrie
+
+
+class NodeTree:
+    """The dict-of-dicts trie used by remigrate mode before FailedPathTrie, kept here as the baseline."""
+
+    def __init__(self):
+        self.children = {}
+        self.is_tail = False
+        self.path = None
+
+    def add_or_get(self, name):
+        if name in self.children:
+            return self.children[name]
+        else:
+            self.children[name] = NodeTree()
+            return self.children[name]
+
+    def check_for_sync(self, path=''):
+        for name, node in self.children.items():
+            child_path = path + '/' + name
+            os.path.exists(child_path)
+        for name, node in self.children.items():
+            child_path = path + '/' + name
+            node.check_for_sync(child_path)
+
+    def get_all_tails(self, out_arr):
+        if self.is_tail:
+            out_arr.append(self.path)
+        else:
+            for name, node in self.children.items():
+                node.get_all_tails(out_arr)
+
+
+def generate_paths(count):
+    random.seed(0)
+    paths = []
+    for i in range(count):
+        paths.append('/mnt/zadara-benchmark/customer{}/project{}/{}/batch{}/file{}.pdf'.format(
+            random.randint(0, 20), random.randint(0, 50), 2010 + random.randint(0, 9), random.randint(0, 10), i))
+    return paths
+
+
+def legacy(paths, granularity):
+    root = NodeTree()
+    for path in paths:
+        file_path = path.split("/")
+        node = root
+        for dir_name in file_path[1:-1]:
+            node = node.add_or_get(dir_name)
+            if node.is_tail:
+                break
+        else:
+            node.is_tail = True
+            node.path = path[:path.rindex('/')]
+            node.children = {}
+    root.check_for_sync()
+    paths_to_sync = []
+    root.get_all_tails(paths_to_sync)
+    return paths_to_sync
+
+
+def trie(paths, granularity):
+    failed_paths = FailedPathTrie(keep_files=granularity != 'directory')
+    for path in paths:
+        failed_paths.add(path)
+    return [path for path, is_directory in failed_paths.targets(granularity)]
+
+
+def run(name, implementation, paths, granularity):
+    start = time.time()
+    targets = implementation(paths, granularity)
+    elapsed = time.time() - start
+    print("{:<8} {:>8.2f}s {:>10} targets".format(name, elapsed, len(targets)))
+    return sorted(targets)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paths', type=int, default=1000000)
+    parser.add_argument('--granularity', choices=['directory', 'file'], default='directory')
+    args = parser.parse_args()
+
+    paths = generate_paths(args.paths)
+    print("{} failed paths, '{}' granularity".format(args.paths, args.granularity))
+    trie_targets = run('trie', trie, paths, args.granularity)
+    if args.granularity == 'directory':
+        legacy_targets = run('legacy', legacy, paths, args.granularity)
+        assert legacy_targets == trie_targets, "trie targets differ from the legacy tree"
+
+
+if __name__ == "__main__":
+    main()
@@ -5,53 +5,887 @@ import argparse
 import subprocess
 import logging
 import re
+import hashlib
+import heapq
+import json
+import mmap
+import shutil
+import stat
+import sqlite3
+import tempfile
+import threading
+import Queue
+from array import array
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import deque
 from difflib import SequenceMatcher
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
-class NodeTree:
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+copy_file_range = getattr(os, 'copy_file_range', None)
 
-    def __init__(self):
-        self.children = {}
-        self.is_tail = False
-        self.path = None
+try:
+    import xxhash
+    new_file_hash, FILE_HASH_ALGORITHM = xxhash.xxh64, 'xxh64'
+except ImportError:
+    if hasattr(hashlib, 'blake2b'):
+        new_file_hash, FILE_HASH_ALGORITHM = hashlib.blake2b, 'blake2b'
+    else:
+        new_file_hash, FILE_HASH_ALGORITHM = hashlib.md5, 'md5'
 
-    def add_or_get(self, name):
-        if name in self.children:
-            return self.children[name]
-        else:
-            self.children[name] = NodeTree()
-            return self.children[name]
+# a file costs about as much rsync time as transferring this many bytes, used to balance buckets by size and count
+FILE_COST_BYTES = 64 * 1024
+# "2019/05/02 10:00:00 [1234] rsync: link_stat "/path/to/file" failed: ..." -> error type and path
+RSYNC_LOG_ERROR_PATTERN = re.compile(r'^[0-9/]+ [0-9:]+ \[[0-9]+\] ([^"]*?)\s*"([^"]+)"')
+# rsync workers print "<bytes> <path>" for every file they transfer
+RSYNC_OUT_FORMAT = '%l %n'
+RSYNC_OUT_FORMAT_PATTERN = re.compile(r'^(\d+) (.+)$')
+# msrsync -P prints "[12/345 entries] [1.2 G/3.4 G transferred] [...]" on one line rewritten with \r
+MSRSYNC_PROGRESS_PATTERN = re.compile(r'\[(\d+)/(\d+) entries\] \[([^/\]]+)/([^\]]+) transferred\]')
+# rsync writes into ".name.XXXXXX" and renames it to "name", failed renames are logged with the temporary name
+RSYNC_TEMP_NAME_PATTERN = re.compile(r'^\.(.+)\.[A-Za-z0-9]{6}$')
 
-    def check_for_sync(self, path=''):
-        for name, node in self.children.items():
-            child_path = path + '/' + name
 
-            if os.path.exists(child_path):
-                child_exists = True
+def list_directory(path):
+    """Return ([(name, size, mtime, inode)] of non-directories, [names] of subdirectories) without following links."""
+    files = []
+    subdirectories = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.name)
             else:
-                # child_exists = False
-                child_exists = True
+                entry_stat = entry.stat(follow_symlinks=False)
+                files.append((entry.name, entry_stat.st_size, entry_stat.st_mtime, entry_stat.st_ino))
+    else:
+        for name in os.listdir(path):
+            entry_stat = os.lstat(os.path.join(path, name))
+            if stat.S_ISDIR(entry_stat.st_mode):
+                subdirectories.append(name)
+            else:
+                files.append((name, entry_stat.st_size, entry_stat.st_mtime, entry_stat.st_ino))
+    return files, subdirectories
 
-            if not child_exists:
-                self.is_tail = True
-                self.path = path or '/'
-                self.children = {}
-                break
 
-        for name, node in self.children.items():
-            child_path = path + '/' + name
-            node.check_for_sync(child_path)
+def copy_file_contents(source_file, destination_file, size):
+    """Copy size bytes between open files, in the kernel when the platform allows it."""
+    copied = 0
+    if copy_file_range is not None or sendfile is not None:
+        try:
+            while copied < size:
+                if copy_file_range is not None:
+                    sent = copy_file_range(source_file.fileno(), destination_file.fileno(), size - copied)
+                else:
+                    sent = sendfile(destination_file.fileno(), source_file.fileno(), copied, size - copied)
+                if not sent:
+                    break
+                copied += sent
+        except OSError:
+            # e.g. copy_file_range across file systems on older kernels, fall back to a read/write copy
+            pass
+    source_file.seek(copied)
+    destination_file.seek(copied)
+    shutil.copyfileobj(source_file, destination_file, 1024 * 1024)
 
-    def get_all_tails(self, out_arr):
-        if self.is_tail:
-            out_arr.append(self.path)
-        else:
-            for name, node in self.children.items():
-                node.get_all_tails(out_arr)
+
+def copy_file(source_path, destination_path):
+    """Copy a file or symlink like rsync -a: into a .name.XXXXXX temp file, then mode, owner, mtime and rename."""
+    source_stat = os.lstat(source_path)
+    if stat.S_ISLNK(source_stat.st_mode):
+        if os.path.lexists(destination_path):
+            os.remove(destination_path)
+        os.symlink(os.readlink(source_path), destination_path)
+        return 0
+    if not stat.S_ISREG(source_stat.st_mode):
+        raise IOError("not a regular file, directory or symlink")
+
+    destination_directory, name = os.path.split(destination_path)
+    temp_fd, temp_path = tempfile.mkstemp(prefix='.{}.'.format(name), suffix='', dir=destination_directory)
+    try:
+        with open(source_path, 'rb') as source_file, os.fdopen(temp_fd, 'wb') as destination_file:
+            copy_file_contents(source_file, destination_file, source_stat.st_size)
+        if os.geteuid() == 0:
+            os.chown(temp_path, source_stat.st_uid, source_stat.st_gid)
+        os.chmod(temp_path, stat.S_IMODE(source_stat.st_mode))
+        os.utime(temp_path, (source_stat.st_atime, source_stat.st_mtime))
+        os.rename(temp_path, destination_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return source_stat.st_size
+
+
+def file_checksum(path, chunk_size=8 * 1024 * 1024):
+    """Hash a file with FILE_HASH_ALGORITHM through a read-only mmap, chunk_size bytes at a time."""
+    checksum = new_file_hash()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in range(0, size, chunk_size):
+                    checksum.update(mapped_file[offset:offset + chunk_size])
+            finally:
+                mapped_file.close()
+    return checksum.hexdigest()
+
+
+def parse_human_size(size):
+    """'1.5 G', '3.4GB' or '512 B' to bytes."""
+    match = re.match(r'\s*([0-9.]+)\s*([KMGTPE]?)', size, re.IGNORECASE)
+    return int(float(match.group(1)) * 1024 ** 'BKMGTPE'.index(match.group(2).upper() or 'B'))
+
+
+def parse_log_file(error_filter, log_file):
+    """Return [(path, error_type)] of the lines of an rsync log matching the error_filter alternation."""
+    error_filter = re.compile(error_filter)
+    failed_files = []
+    unparsed_lines = 0
+    with open(log_file, mode='r') as log:
+        for line in log:
+            if not error_filter.search(line):
+                continue
+            match = RSYNC_LOG_ERROR_PATTERN.match(line)
+            if match is None:
+                unparsed_lines += 1
+                continue
+            failed_files.append((match.group(2), match.group(1)))
+    return log_file, failed_files, unparsed_lines
+
+
+class DirectoryWalker:
+
+    def __init__(self, threads):
+        self.threads = threads
+
+    def walk(self, root, lister=None):
+        """Yield (relative_dir, listing) for every directory under root, listing them in parallel.
+
+        `lister(root, relative_dir)` returns a tuple whose first two items are the files and the subdirectory
+        names of the directory, by default the result of list_directory.
+        """
+        lister = lister or (lambda root, relative_dir: list_directory(os.path.join(root, relative_dir)))
+        pool = ThreadPool(self.threads)
+        listings = Queue.Queue()
+
+        def list_one(relative_dir):
+            try:
+                listings.put((relative_dir, lister(root, relative_dir), None))
+            except (OSError, IOError) as e:
+                listings.put((relative_dir, None, e))
+
+        pending = 1
+        pool.apply_async(list_one, ('',))
+        try:
+            while pending:
+                relative_dir, listing, error = listings.get()
+                pending -= 1
+                if error is not None:
+                    logging.warning("Could not list directory {}: {}".format(os.path.join(root, relative_dir), error))
+                    continue
+                for subdirectory in listing[1]:
+                    pending += 1
+                    pool.apply_async(list_one, (os.path.join(relative_dir, subdirectory),))
+                yield relative_dir, listing
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+class SyncTelemetry:
+    """Live progress of a sync run, fed from the rsync/msrsync output while it runs.
+
+    Every `interval` seconds a sample of the transferred files and bytes is taken, rates are computed over the
+    samples of the last `window` seconds and the status is written to `status_file` as JSON. serve() exposes
+    the same status as Prometheus text on http://0.0.0.0:<port>/metrics, every metric carrying `labels`.
+    """
+
+    def __init__(self, status_file=None, interval=10, window=60, labels=None):
+        self.status_file = status_file
+        self.interval = interval
+        self.window = window
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.writer = None
+        self.__reset__(None, None)
+
+    def __reset__(self, source, destination):
+        with self.lock:
+            self.source = source
+            self.destination = destination
+            self.started = time.time()
+            self.files_done = 0
+            self.bytes_done = 0
+            self.files_total = None
+            self.bytes_total = None
+            self.buckets = {}
+            self.samples = deque()
+
+    def start(self, source, destination):
+        self.__reset__(source, destination)
+        self.stopped.clear()
+        if self.status_file:
+            self.writer = threading.Thread(target=self.__write_status_loop__, name='rfsync-status')
+            self.writer.daemon = True
+            self.writer.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+
+    def set_totals(self, files_total, bytes_total):
+        with self.lock:
+            self.files_total = files_total
+            self.bytes_total = bytes_total
+
+    def bucket_started(self, bucket):
+        with self.lock:
+            self.buckets[bucket.index] = {'state': 'running', 'files_done': 0, 'bytes_done': 0,
+                                          'files_total': bucket.files, 'bytes_total': bucket.size,
+                                          'started': time.time()}
+
+    def bucket_finished(self, index, return_code):
+        with self.lock:
+            self.buckets[index]['state'] = 'done' if return_code == 0 else 'failed'
+            self.buckets[index]['return_code'] = return_code
+
+    def add(self, index, files, size):
+        with self.lock:
+            self.files_done += files
+            self.bytes_done += size
+            if index is not None:
+                self.buckets[index]['files_done'] += files
+                self.buckets[index]['bytes_done'] += size
+
+    def set_progress(self, files_done, files_total, bytes_done, bytes_total):
+        with self.lock:
+            self.files_done, self.files_total = files_done, files_total
+            self.bytes_done, self.bytes_total = bytes_done, bytes_total
+
+    def __sample__(self):
+        now = time.time()
+        self.samples.append((now, self.files_done, self.bytes_done))
+        while len(self.samples) > 2 and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+
+    def status(self):
+        with self.lock:
+            self.__sample__()
+            first_time, first_files, first_bytes = self.samples[0]
+            last_time, last_files, last_bytes = self.samples[-1]
+            elapsed = last_time - first_time
+            files_per_second = (last_files - first_files) / elapsed if elapsed else 0.0
+            bytes_per_second = (last_bytes - first_bytes) / elapsed if elapsed else 0.0
+            eta = None
+            if self.bytes_total is not None and bytes_per_second:
+                eta = max(self.bytes_total - self.bytes_done, 0) / bytes_per_second
+            elif self.files_total is not None and files_per_second:
+                eta = max(self.files_total - self.files_done, 0) / files_per_second
+            return {'source': self.source, 'destination': self.destination, 'updated': time.time(),
+                    'elapsed_seconds': time.time() - self.started,
+                    'files_done': self.files_done, 'files_total': self.files_total,
+                    'bytes_done': self.bytes_done, 'bytes_total': self.bytes_total,
+                    'files_per_second': files_per_second, 'bytes_per_second': bytes_per_second,
+                    'eta_seconds': eta, 'buckets': dict((str(index), dict(bucket))
+                                                        for index, bucket in self.buckets.items())}
+
+    def metric_samples(self):
+        """Return [(metric name, metric type, labels, value)] of the current status."""
+        status = self.status()
+        samples = []
+        for name, metric_type, value in [('rfsync_files_transferred_total', 'counter', status['files_done']),
+                                         ('rfsync_bytes_transferred_total', 'counter', status['bytes_done']),
+                                         ('rfsync_files_planned', 'gauge', status['files_total']),
+                                         ('rfsync_bytes_planned', 'gauge', status['bytes_total']),
+                                         ('rfsync_files_per_second', 'gauge', status['files_per_second']),
+                                         ('rfsync_bytes_per_second', 'gauge', status['bytes_per_second']),
+                                         ('rfsync_eta_seconds', 'gauge', status['eta_seconds'])]:
+            if value is not None:
+                samples.append((name, metric_type, self.labels, value))
+        for index, bucket in sorted(status['buckets'].items()):
+            labels = dict(self.labels, bucket=index, state=bucket['state'])
+            samples.append(('rfsync_bucket_bytes_transferred', 'gauge', labels, bucket['bytes_done']))
+            samples.append(('rfsync_bucket_files_transferred', 'gauge', labels, bucket['files_done']))
+        return samples
+
+    def prometheus(self):
+        return prometheus_text(self.metric_samples())
+
+    def __write_status__(self):
+        temp_status_file = self.status_file + '.tmp'
+        with open(temp_status_file, 'w') as status_file:
+            json.dump(self.status(), status_file, indent=2, sort_keys=True)
+        os.rename(temp_status_file, self.status_file)
+
+    def __write_status_loop__(self):
+        while not self.stopped.wait(self.interval):
+            self.__write_status__()
+        self.__write_status__()
+
+    def serve(self, port):
+        serve_metrics(port, self.prometheus)
+
+
+def prometheus_text(samples):
+    """Render [(metric name, metric type, labels, value)] as Prometheus text, one TYPE line per metric."""
+    metrics = {}
+    for name, metric_type, labels, value in samples:
+        metrics.setdefault((name, metric_type), []).append((labels, value))
+    lines = []
+    for (name, metric_type), values in sorted(metrics.items()):
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        for labels, value in values:
+            label_text = ','.join('{}="{}"'.format(key, str(label).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for key, label in sorted(labels.items()))
+            lines.append('{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', value))
+    return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(port, prometheus):
+    """Serve the text returned by prometheus() on http://0.0.0.0:<port>/metrics from a daemon thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = prometheus()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("Metrics request: " + format % args)
+
+    server = HTTPServer(('', port), MetricsHandler)
+    server_thread = threading.Thread(target=server.serve_forever, name='rfsync-metrics')
+    server_thread.daemon = True
+    server_thread.start()
+    logging.info("Serving Prometheus metrics on port {}".format(port))
+
+
+class SyncSchedule:
+    """Time-of-day windows capping the number of sync workers and the bandwidth of each of them.
+
+    The schedule file holds a list of windows, e.g.
+        [{"days": ["mon", "tue", "wed", "thu", "fri"], "start": "08:00", "end": "19:00",
+          "parallelism": 4, "bwlimit": 20000}]
+    where "days" is optional, a window may end past midnight and "bwlimit" is in KB/s per worker. The first
+    matching window wins, outside every window `parallelism` workers run without a bandwidth cap.
+    """
+    DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+    def __init__(self, windows, parallelism):
+        self.windows = windows
+        self.parallelism = parallelism
+
+    @classmethod
+    def load(cls, schedule_file, parallelism):
+        with open(schedule_file) as schedule:
+            windows = json.load(schedule)
+        for window in windows:
+            window['start'] = time.strptime(window['start'], '%H:%M')[3:5]
+            window['end'] = time.strptime(window['end'], '%H:%M')[3:5]
+            if not set(window.get('days', [])) <= set(cls.DAYS):
+                raise ValueError("Schedule days must be in {}: {}".format(cls.DAYS, window['days']))
+        return cls(windows, parallelism)
+
+    def current(self, now=None):
+        """Return (parallelism, bwlimit or None) of the window active at now."""
+        now = time.localtime(now)
+        clock = (now.tm_hour, now.tm_min)
+        for window in self.windows:
+            if 'days' in window and self.DAYS[now.tm_wday] not in window['days']:
+                continue
+            if window['start'] <= window['end']:
+                active = window['start'] <= clock < window['end']
+            else:
+                active = clock >= window['start'] or clock < window['end']
+            if active:
+                return window.get('parallelism', self.parallelism), window.get('bwlimit')
+        return self.parallelism, None
+
+    def max_parallelism(self):
+        return max([self.parallelism] + [window.get('parallelism', self.parallelism) for window in self.windows])
+
+
+class WorkerGate:
+    """Lets at most the scheduled number of workers run at once, re-reading the schedule while they wait.
+
+    Pools are sized for the busiest window, and a worker acquires the gate before every bucket (or file for
+    the native engine). Lowering the limit lets running work finish and holds back new work. When several
+    syncs share a gate, a free slot goes to the waiting worker with the lowest priority value first.
+    """
+
+    def __init__(self, schedule, recheck_seconds=30):
+        self.schedule = schedule
+        self.recheck_seconds = recheck_seconds
+        self.condition = threading.Condition()
+        self.active = 0
+        self.limit = None
+        self.bwlimit = None
+        self.waiting = []
+
+    def acquire(self, priority=0):
+        """Block until a worker may start and return its bandwidth cap in KB/s, or None."""
+        with self.condition:
+            heapq.heappush(self.waiting, priority)
+            try:
+                while True:
+                    limit, bwlimit = self.schedule.current()
+                    if (limit, bwlimit) != (self.limit, self.bwlimit):
+                        logging.info("Schedule: running up to {} workers, bandwidth limit per worker: {}".format(
+                            limit, "{} KB/s".format(bwlimit) if bwlimit else "none"))
+                        self.limit, self.bwlimit = limit, bwlimit
+                        self.condition.notify_all()
+                    if self.active < limit and priority <= self.waiting[0]:
+                        self.active += 1
+                        return bwlimit
+                    self.condition.wait(self.recheck_seconds)
+            finally:
+                self.waiting.remove(priority)
+                heapq.heapify(self.waiting)
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+
+class RunDatabase:
+    """SQLite record of the mount pairs of an orchestrated migration and of how far each one got.
+
+    A pair is PENDING, RUNNING, PAUSED, DONE or FAILED and keeps the start and end time, bytes and files of its
+    last run. Pausing a pair only flips its status, the running sync checks it before every bucket.
+    """
+    STATUSES = ['PENDING', 'RUNNING', 'PAUSED', 'DONE', 'FAILED']
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.text_factory = str
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS pairs (source TEXT, destination TEXT, priority INTEGER, status TEXT,
+                                              start_time TEXT, end_time TEXT, bytes INTEGER, files INTEGER,
+                                              PRIMARY KEY (source, destination));
+        """)
+
+    def load_pairs(self, pairs_file):
+        """Add the SOURCE, DESTINATION, PRIORITY rows of pairs_file, keeping the status of known pairs."""
+        with open(pairs_file, mode="r") as pairs, self.lock:
+            for row in csv.DictReader(pairs):
+                self.connection.execute("INSERT OR IGNORE INTO pairs (source, destination, priority, status) "
+                                        "VALUES (?, ?, ?, 'PENDING')",
+                                        (row['SOURCE'], row['DESTINATION'], int(row.get('PRIORITY') or 0)))
+                self.connection.execute("UPDATE pairs SET priority = ? WHERE source = ? AND destination = ?",
+                                        (int(row.get('PRIORITY') or 0), row['SOURCE'], row['DESTINATION']))
+            # a pair still RUNNING was interrupted with the previous orchestrator
+            self.connection.execute("UPDATE pairs SET status = 'PENDING' WHERE status = 'RUNNING'")
+            self.connection.commit()
+
+    def pending_pairs(self):
+        with self.lock:
+            return self.connection.execute("SELECT source, destination, priority FROM pairs "
+                                           "WHERE status = 'PENDING' ORDER BY priority, source").fetchall()
+
+    def status(self, source, destination):
+        with self.lock:
+            row = self.connection.execute("SELECT status FROM pairs WHERE source = ? AND destination = ?",
+                                          (source, destination)).fetchone()
+        return row[0] if row else None
+
+    def set_status(self, source, destination, status):
+        with self.lock:
+            updated = self.connection.execute("UPDATE pairs SET status = ? WHERE source = ? AND destination = ?",
+                                              (status, source, destination)).rowcount
+            self.connection.commit()
+        return updated
+
+    def pause_check(self, source, destination, recheck_seconds=5):
+        """Return a callable telling whether the pair has been paused, reading the database at most every few seconds."""
+        checked = [0, False]
+
+        def paused():
+            if time.time() - checked[0] >= recheck_seconds:
+                checked[:] = [time.time(), self.status(source, destination) == 'PAUSED']
+            return checked[1]
+        return paused
+
+    def start(self, source, destination):
+        with self.lock:
+            self.connection.execute("UPDATE pairs SET status = 'RUNNING', start_time = ?, end_time = NULL, "
+                                    "bytes = 0, files = 0 WHERE source = ? AND destination = ?",
+                                    (time.asctime(), source, destination))
+            self.connection.commit()
+
+    def finish(self, source, destination, status, transferred_bytes, transferred_files):
+        with self.lock:
+            self.connection.execute("UPDATE pairs SET status = ?, end_time = ?, bytes = ?, files = ? "
+                                    "WHERE source = ? AND destination = ?",
+                                    (status, time.asctime(), transferred_bytes, transferred_files, source,
+                                     destination))
+            self.connection.commit()
+
+    def summary(self):
+        with self.lock:
+            return self.connection.execute("SELECT status, COUNT(*), SUM(bytes), SUM(files) FROM pairs "
+                                           "GROUP BY status").fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+class FileManifest:
+    """SQLite index of (path, size, mtime, inode) of every file per source tree, kept between sync runs.
+
+    A directory whose mtime matches the manifest is not listed again, its subdirectories come from the manifest.
+    Changed directories are listed and only their new or changed files are handed to the planner. What a run
+    saw is staged and only written to the manifest by commit(), once the sync succeeded.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = str
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS directories (source TEXT, path TEXT, mtime REAL, subdirectories TEXT,
+                                                    PRIMARY KEY (source, path));
+            CREATE TABLE IF NOT EXISTS files (source TEXT, path TEXT, directory TEXT, size INTEGER, mtime REAL,
+                                              inode INTEGER, PRIMARY KEY (source, path));
+            CREATE INDEX IF NOT EXISTS files_by_directory ON files (source, directory);
+            CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, directory TEXT, inode INTEGER,
+                                                  size INTEGER, mtime REAL, algorithm TEXT, digest TEXT);
+            CREATE INDEX IF NOT EXISTS checksums_by_directory ON checksums (directory);
+            CREATE TEMP TABLE staged_directories (path TEXT PRIMARY KEY, mtime REAL, subdirectories TEXT);
+            CREATE TEMP TABLE staged_files (path TEXT, directory TEXT, size INTEGER, mtime REAL, inode INTEGER);
+        """)
+
+    def changed_files(self, source, walker):
+        """Yield (relative_dir, changed files, subdirectories) for every directory whose mtime changed."""
+        source = os.path.abspath(source)
+        known_directories = dict(
+            (path, (mtime, subdirectories.split('\0') if subdirectories else []))
+            for path, mtime, subdirectories in self.connection.execute(
+                "SELECT path, mtime, subdirectories FROM directories WHERE source = ?", (source,)))
+        logging.info("Manifest knows {} directories of '{}'".format(len(known_directories), source))
+
+        def list_changed(root, relative_dir):
+            path = os.path.join(root, relative_dir)
+            # stat before listing, so a directory changing while it is listed is diffed again next run
+            mtime = os.stat(path).st_mtime
+            known = known_directories.get(relative_dir)
+            if known is not None and known[0] == mtime:
+                return None, known[1], mtime
+            files, subdirectories = list_directory(path)
+            return files, subdirectories, mtime
+
+        changed_directories = 0
+        for relative_dir, (files, subdirectories, mtime) in walker.walk(source, list_changed):
+            if files is None:
+                continue
+            changed_directories += 1
+            known_files = dict((name, (size, file_mtime, inode)) for name, size, file_mtime, inode in
+                               self.connection.execute("SELECT path, size, mtime, inode FROM files "
+                                                       "WHERE source = ? AND directory = ?", (source, relative_dir)))
+            self.connection.execute("INSERT OR REPLACE INTO staged_directories VALUES (?, ?, ?)",
+                                    (relative_dir, mtime, '\0'.join(subdirectories)))
+            self.connection.executemany("INSERT INTO staged_files VALUES (?, ?, ?, ?, ?)",
+                                        [(os.path.join(relative_dir, name), relative_dir, size, file_mtime, inode)
+                                         for name, size, file_mtime, inode in files])
+            changed = [(name, size, file_mtime, inode) for name, size, file_mtime, inode in files
+                       if known_files.get(os.path.join(relative_dir, name)) != (size, file_mtime, inode)]
+            yield relative_dir, changed, subdirectories
+        logging.info("{} directories of '{}' changed since the last manifest".format(changed_directories, source))
+
+    def file_counts(self, source):
+        """Return {directory relative to source as '/dir/subdir': number of files below it} of the manifest of
+        source, the root being '/'."""
+        source = os.path.abspath(source)
+        counts = {}
+        for directory, count in self.connection.execute(
+                "SELECT directory, COUNT(*) FROM files WHERE source = ? GROUP BY directory", (source,)):
+            path = '/' + directory.strip('/')
+            while True:
+                counts[path] = counts.get(path, 0) + count
+                if path == '/':
+                    break
+                path = os.path.dirname(path)
+        return counts
+
+    def cached_checksums(self, directory):
+        """Return {path: ((inode, size, mtime), digest)} of the files of directory hashed with FILE_HASH_ALGORITHM."""
+        return dict((path, ((inode, size, mtime), digest)) for path, inode, size, mtime, digest in
+                    self.connection.execute("SELECT path, inode, size, mtime, digest FROM checksums "
+                                            "WHERE directory = ? AND algorithm = ?",
+                                            (os.path.abspath(directory), FILE_HASH_ALGORITHM)))
+
+    def save_checksums(self, checksums):
+        """Cache [(path, (inode, size, mtime), digest)]."""
+        self.connection.executemany("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    [(path, os.path.dirname(path), inode, size, mtime, FILE_HASH_ALGORITHM, digest)
+                                     for path, (inode, size, mtime), digest in checksums])
+        self.connection.commit()
+
+    def commit(self, source):
+        source = os.path.abspath(source)
+        self.connection.execute("DELETE FROM files WHERE source = ? AND directory IN "
+                                "(SELECT path FROM staged_directories)", (source,))
+        self.connection.execute("INSERT OR REPLACE INTO files SELECT ?, path, directory, size, mtime, inode "
+                                "FROM staged_files", (source,))
+        self.connection.execute("INSERT OR REPLACE INTO directories SELECT ?, path, mtime, subdirectories "
+                                "FROM staged_directories", (source,))
+        self.discard()
+        logging.info("Manifest of '{}' updated".format(source))
+
+    def discard(self):
+        self.connection.execute("DELETE FROM staged_directories")
+        self.connection.execute("DELETE FROM staged_files")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class Bucket:
+
+    def __init__(self, index, list_path):
+        self.index = index
+        self.list_path = list_path
+        self.log_path = list_path[:-len('.list')] + '.log'
+        self.size = 0
+        self.files = 0
+        self.directories = 0
+
+    @property
+    def cost(self):
+        return self.size + self.files * FILE_COST_BYTES
+
+
+class SyncPlanner:
+    """Splits a source tree into buckets balanced by bytes and file count, one rsync --files-from list per bucket.
+
+    Directories are listed in parallel and their files are handed out in units of at most `max_files_per_unit`,
+    each going to the bucket with the lowest cost so far. Bucket lists are NUL separated paths relative to source,
+    written as the walk goes so the plan never has to hold the whole tree in memory.
+    """
+
+    def __init__(self, walk_threads, bucket_count, max_files_per_unit=10000, manifest=None):
+        self.walker = DirectoryWalker(walk_threads)
+        self.bucket_count = bucket_count
+        self.max_files_per_unit = max_files_per_unit
+        self.manifest = manifest
+
+    def listings(self, source):
+        """Yield (relative_dir, files, subdirectories) of source, only the changed files when there is a manifest."""
+        if self.manifest is not None:
+            return self.manifest.changed_files(source, self.walker)
+        return ((relative_dir, files, subdirectories)
+                for relative_dir, (files, subdirectories) in self.walker.walk(source))
+
+    def plan(self, source, plan_directory):
+        if not os.path.exists(plan_directory):
+            os.makedirs(plan_directory)
+        buckets = [Bucket(index, os.path.join(plan_directory, 'bucket-{:04d}.list'.format(index)))
+                   for index in range(self.bucket_count)]
+        bucket_lists = [open(bucket.list_path, 'wb') for bucket in buckets]
+        heap = [(0, bucket.index) for bucket in buckets]
+        try:
+            for relative_dir, files, subdirectories in self.listings(source):
+                for start in range(0, max(len(files), 1), self.max_files_per_unit):
+                    unit = files[start:start + self.max_files_per_unit]
+                    cost, index = heapq.heappop(heap)
+                    bucket = buckets[index]
+                    if start == 0 and relative_dir:
+                        # list the directory itself so empty directories are created too
+                        bucket_lists[index].write(relative_dir + '\0')
+                        bucket.directories += 1
+                    for name, size, mtime, inode in unit:
+                        bucket_lists[index].write(os.path.join(relative_dir, name) + '\0')
+                        bucket.size += size
+                    bucket.files += len(unit)
+                    heapq.heappush(heap, (bucket.cost, index))
+        finally:
+            for bucket_list in bucket_lists:
+                bucket_list.close()
+        return [bucket for bucket in buckets if bucket.files or bucket.directories]
+
+    def report(self, buckets):
+        if not buckets:
+            logging.info("Sync plan is empty - nothing to sync")
+            return
+        total_size = sum(bucket.size for bucket in buckets)
+        total_files = sum(bucket.files for bucket in buckets)
+        logging.info("Sync plan: {} buckets, {} files, {} bytes".format(len(buckets), total_files, total_size))
+        for bucket in buckets:
+            logging.info("Bucket {:04d}: {} files, {} directories, {} bytes".format(
+                bucket.index, bucket.files, bucket.directories, bucket.size))
+        costs = [bucket.cost for bucket in buckets]
+        logging.info("Bucket cost min/avg/max: {}/{}/{}".format(min(costs), sum(costs) // len(costs), max(costs)))
+
+
+class FailedPathTrie:
+    """Failed file paths as a trie of interned path segments.
+
+    Nodes are indexes into parallel arrays (parent, segment id, is file, failed files directly below) and a
+    child is found through one dict keyed by parent << 32 | segment id, so a million failed paths cost a few
+    flat arrays rather than a dict per directory. The node of every directory seen is cached by its path, so
+    the many failed files of one directory only walk the trie once. Nothing is stat'ed, how many files a directory holds comes
+    from the manifest when there is one. Without keep_files only directories are stored, which is all the
+    'directory' granularity needs, except for files directly below the root, which no directory target covers.
+    """
+    ROOT = 0
+
+    def __init__(self, keep_files=True):
+        self.keep_files = keep_files
+        self.segment_ids = {}
+        self.segments = []
+        self.parents = array('l', [-1])
+        self.node_segments = array('l', [-1])
+        self.is_file = array('b', [0])
+        self.failed = array('l', [0])
+        self.children = {}
+        self.directory_nodes = {}
+
+    def __segment_id__(self, segment):
+        segment_id = self.segment_ids.get(segment)
+        if segment_id is None:
+            segment_id = self.segment_ids[segment] = len(self.segments)
+            self.segments.append(segment)
+        return segment_id
+
+    def __child__(self, node, segment):
+        key = node << 32 | self.__segment_id__(segment)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = len(self.parents)
+            self.parents.append(node)
+            self.node_segments.append(self.segment_ids[segment])
+            self.is_file.append(0)
+            self.failed.append(0)
+        return child
+
+    def add(self, file_path, renamed=False):
+        directory, _, name = file_path.rstrip('/').rpartition('/')
+        if not name:
+            return
+        if renamed:
+            temp_name = RSYNC_TEMP_NAME_PATTERN.match(name)
+            if temp_name is not None:
+                name = temp_name.group(1)
+        node = self.directory_nodes.get(directory)
+        if node is None:
+            node = self.ROOT
+            for segment in directory.split('/'):
+                if segment:
+                    node = self.__child__(node, segment)
+            self.directory_nodes[directory] = node
+        if not self.keep_files and node != self.ROOT:
+            self.failed[node] += 1
+            return
+        file_node = self.__child__(node, name)
+        if not self.is_file[file_node]:
+            self.is_file[file_node] = 1
+            self.failed[node] += 1
+
+    def __failed_totals__(self):
+        totals = array('l', self.failed)
+        # children are always created after their parent, so one pass from the back adds up every subtree
+        for node in range(len(self.parents) - 1, 0, -1):
+            totals[self.parents[node]] += totals[node]
+        return totals
+
+    def __child_index__(self):
+        order = sorted(range(1, len(self.parents)), key=self.parents.__getitem__)
+        first_child = array('l', [0] * (len(self.parents) + 1))
+        for node in order:
+            first_child[self.parents[node] + 1] += 1
+        for node in range(len(self.parents)):
+            first_child[node + 1] += first_child[node]
+        return order, first_child
+
+    def targets(self, granularity='directory', present_counts=None, collapse_ratio=0.5):
+        """Return [(path, is_directory)], the smallest set of paths whose re-sync covers every failed file.
+
+        'file' re-syncs every failed file on its own and 'directory' every directory holding failed files.
+        'auto' re-syncs a whole directory once its failed files make up at least collapse_ratio of the files
+        below it in present_counts ({path: files below}), and its failed files and subdirectories otherwise.
+        Directories missing from present_counts are handled like 'directory'.
+        """
+        present_counts = present_counts or {}
+        totals = self.__failed_totals__() if granularity == 'auto' else None
+        order, first_child = self.__child_index__()
+        targets = []
+        stack = [(self.ROOT, '')]
+        while stack:
+            node, path = stack.pop()
+            if self.is_file[node]:
+                targets.append((path, False))
+                continue
+            if node != self.ROOT:
+                if granularity == 'directory' and self.failed[node]:
+                    targets.append((path, True))
+                    continue
+                if granularity == 'auto':
+                    present = present_counts.get(path)
+                    if present is None and self.failed[node] or present and totals[node] >= collapse_ratio * present:
+                        targets.append((path, True))
+                        continue
+            for child in order[first_child[node]:first_child[node + 1]]:
+                stack.append((child, path + '/' + self.segments[self.node_segments[child]]))
+        return targets
 
 
 class SyncService:
 
+    def __init__(self, engine='msrsync', parallelism=14, walk_threads=16, bucket_count=None, manifest_path=None,
+                 remigrate_batch_size=500, validate_with='exists', telemetry=None, schedule=None, gate=None,
+                 priority=0, pause_check=None, output_directory='.'):
+        self.engine = engine
+        self.parallelism = parallelism
+        self.walk_threads = walk_threads
+        self.bucket_count = bucket_count or parallelism * 4  # several buckets per worker so fast workers take more
+        self.manifest_path = manifest_path
+        self.remigrate_batch_size = remigrate_batch_size
+        self.validate_with = validate_with
+        self.telemetry = telemetry or SyncTelemetry()
+        self.schedule = schedule or SyncSchedule([], parallelism)
+        self.gate = gate or WorkerGate(self.schedule)
+        self.priority = priority
+        self.pause_check = pause_check or (lambda: False)
+        self.output_directory = output_directory
+
+    def __output_path__(self, file_name):
+        """Path of one of the FAILED_LOGS.csv, msrsync_out.txt, msrsync_err.txt files this sync writes."""
+        return os.path.join(self.output_directory, file_name)
+
+    def __new_plan_directory__(self, prefix="rfsync"):
+        """Create a directory of its own under the logs directory of output_directory for the bucket lists and
+        logs of one run, so generate-logs run from output_directory finds them."""
+        logs_directory = os.path.join(os.path.abspath(self.output_directory), "logs")
+        if not os.path.exists(logs_directory):
+            os.makedirs(logs_directory)
+        # runs starting in the same second, e.g. concurrent pairs, must not share their bucket lists
+        return tempfile.mkdtemp(dir=logs_directory, prefix="{}-{}-".format(prefix, time.strftime("%Y%m%d-%H%M%S")))
+
     def __calculate_msrsync_timing__(self, start_time, end_time):
         logging.debug("Calculating time taken for migration")
         local_start_time = time.asctime(time.localtime(start_time))
@@ -72,69 +906,448 @@ class SyncService:
                 writer.writerow([row[0], "READY_TO_MIGRATE"])
             os.rename("temp.csv", "FAILED_LOGS.csv")
 
-    def __check_if_folder_needs_remigration__(self, failed_log_file_abs_path):
+    def __check_if_folder_needs_remigration__(self, failed_log_file_abs_path, source_mount_point,
+                                              destination_mount_point, granularity, present_counts, collapse_ratio):
+        """Return [(path relative to source_mount_point as '/dir/name', is_directory)] to re-sync and the set of
+        paths verify mode found with a different checksum."""
         logging.debug("Checking which folders needs re-migration")
-        root = NodeTree()
+        failed_paths = FailedPathTrie(keep_files=granularity != 'directory')
+        checksum_mismatches = set()
         with open(failed_log_file_abs_path, mode="r") as failed_log:
             reader = csv.reader(failed_log, delimiter=',')
             next(reader)
             logging.debug("Iterating through each row in FAILED_LOGS.csv to find which folders to re-migrate")
             for row in reader:
-                logging.debug("Failed File row: {}".format(row))
-                file_path = row[0].split("/")
-                node = root
-                for dir_name in file_path[1:-1]:
-                    node = node.add_or_get(dir_name)
-                    if node.is_tail:
-                        break
-                else:
-                    node.is_tail = True
-                    node.path = row[0][:row[0].rindex('/')]
-                    node.children = {}
-        root.check_for_sync()
-        paths_to_sync = []
-        root.get_all_tails(paths_to_sync)
-        return paths_to_sync
-
-    def __validate_remigrated_files__(self, failed_log_file_abs_path, source_mount_point, destination_mount_point):
-        with open(failed_log_file_abs_path, mode="r") as failed_log, open("temp.csv", "w") as outFile:
+                if row[1] == "CHECKSUM_MISMATCH":
+                    checksum_mismatches.add(row[0])
+                # rsync logs some errors under the source path and some under the destination path
+                source_destination_dict = self.__find_source_destination_for_remigration__(
+                    row[0], source_mount_point, destination_mount_point)
+                relative = source_destination_dict and os.path.relpath(source_destination_dict["source"],
+                                                                       source_mount_point)
+                if relative is None or relative == '.' or relative == '..' or relative.startswith('../'):
+                    logging.warning("Skipping {} - it is not below '{}'".format(row[0], source_mount_point))
+                    continue
+                failed_paths.add('/' + relative, renamed=row[1].startswith('rsync: rename'))
+        paths_to_sync = failed_paths.targets(granularity, present_counts, collapse_ratio)
+        logging.info("{} failed files collapse to {} folders and {} files to re-sync with '{}' granularity".format(
+            sum(failed_paths.failed), sum(1 for path, is_directory in paths_to_sync if is_directory),
+            sum(1 for path, is_directory in paths_to_sync if not is_directory), granularity))
+        return paths_to_sync, checksum_mismatches
+
+    def __validate_directory__(self, directory):
+        """Validate the failed (file_name, name, validate_with) files of one directory with a single listing of it
+        and return their rows."""
+        source_directory, destination_directory, files = directory
+        try:
+            destination_files, destination_subdirectories = list_directory(destination_directory)
+        except (OSError, IOError):
+            return [[file_name, "FAILED"] for file_name, name, validate_with in files]
+        existing = dict((name, (size, mtime)) for name, size, mtime, inode in destination_files)
+        existing.update((name, None) for name in destination_subdirectories)
+
+        source_files = {}
+        if any(validate_with == 'attributes' for file_name, name, validate_with in files):
+            try:
+                source_files = dict((name, (size, mtime))
+                                    for name, size, mtime, inode in list_directory(source_directory)[0])
+            except (OSError, IOError):
+                pass
+
+        rows = []
+        for file_name, name, validate_with in files:
+            status = "SUCCESS" if name in existing else "FAILED"
+            if status == "SUCCESS" and existing[name] is not None:
+                if validate_with == 'attributes':
+                    source_attributes = source_files.get(name)
+                    # rsync -a keeps mtime to the second, NFS may not keep the fraction
+                    if source_attributes is None or source_attributes[0] != existing[name][0] or \
+                            int(source_attributes[1]) != int(existing[name][1]):
+                        status = "FAILED"
+                elif validate_with == 'checksum':
+                    try:
+                        if file_checksum(os.path.join(source_directory, name)) != \
+                                file_checksum(os.path.join(destination_directory, name)):
+                            status = "CHECKSUM_MISMATCH"
+                    except (OSError, IOError):
+                        status = "FAILED"
+            logging.debug("Validated {}: {}".format(file_name, status))
+            rows.append([file_name, status])
+        return rows
+
+    def __validate_remigrated_files__(self, failed_log_file_abs_path, source_mount_point, destination_mount_point,
+                                      checksum_mismatches=()):
+        """Rewrite FAILED_LOGS.csv with the status of every row after remigrating. Rows verify mode found with a
+        different checksum are always validated by checksum and keep CHECKSUM_MISMATCH while they still differ."""
+        directories = {}
+        foreign_rows = []
+        with open(failed_log_file_abs_path, mode="r") as failed_log:
             reader = csv.reader(failed_log, delimiter=',')
-            writer = csv.writer(outFile, delimiter=',')
             header = next(reader)
-            writer.writerow(header)
-            logging.debug("Checking if files remigrated successfully and updating the FAILED_LOGS.csv")
             for row in reader:
-                file_name_destination = row[0].replace(source_mount_point, destination_mount_point)
-                if os.path.exists(file_name_destination):
-                    row[1] = "SUCCESS"
-                    line = [row[0],row[1]]
-                    writer.writerow(line)
-                else:
-                    row[1] = "FAILED"
-                    line = [row[0], row[1]]
-                    writer.writerow(line)
-            os.rename("temp.csv", "FAILED_LOGS.CSV")
-            logging.info("Updated FAILED_LOGS.csv with new migration status for failed files")
+                source_destination_dict = self.__find_source_destination_for_remigration__(
+                    row[0], source_mount_point, destination_mount_point)
+                if source_destination_dict is None:
+                    # not remigrated, see __check_if_folder_needs_remigration__
+                    foreign_rows.append([row[0], "FAILED"])
+                    continue
+                source_directory = os.path.dirname(source_destination_dict["source"])
+                destination_directory, name = os.path.split(source_destination_dict["destination"])
+                # only failed renames are logged under the destination, with rsync's ".name.XXXXXX" temp name
+                temp_name = RSYNC_TEMP_NAME_PATTERN.match(name)
+                if temp_name is not None and row[0].startswith(destination_mount_point.rstrip('/') + '/'):
+                    name = temp_name.group(1)
+                validate_with = 'checksum' if row[0] in checksum_mismatches else self.validate_with
+                directories.setdefault((source_directory, destination_directory), []).append(
+                    (row[0], name, validate_with))
+
+        logging.debug("Checking if files remigrated successfully in {} directories with {} threads".format(
+            len(directories), self.walk_threads))
+        pool = ThreadPool(self.walk_threads)
+        failed_files = len(foreign_rows)
+        with open(failed_log_file_abs_path, mode="w") as failed_log:
+            writer = csv.writer(failed_log, delimiter=',')
+            writer.writerow(header)
+            writer.writerows(foreign_rows)
+            for rows in pool.imap_unordered(self.__validate_directory__,
+                                            [(source_directory, destination_directory, files) for
+                                             (source_directory, destination_directory), files in
+                                             directories.iteritems()]):
+                writer.writerows(rows)
+                failed_files += sum(1 for row in rows if row[1] != "SUCCESS")
+        pool.close()
+        pool.join()
+        logging.info("Updated FAILED_LOGS.csv with new migration status for failed files - {} still failed".format(
+            failed_files))
 
     def sync_files_between(self, source, destination, rsync_flags):
+        self.telemetry.start(source, destination)
+        try:
+            if self.engine == 'planner':
+                return self.__sync_planned_buckets__(source, destination, rsync_flags)
+            if self.engine == 'native':
+                return self.__sync_natively__(source, destination)
+            return self.__sync_with_msrsync__(source, destination, rsync_flags)
+        finally:
+            self.telemetry.stop()
+
+    def __follow_msrsync_progress__(self, msrsync_stdout):
+        """Copy msrsync's output to msrsync_out.txt and feed its progress lines to the telemetry."""
+        pending = ''
+        with open(self.__output_path__("msrsync_out.txt"), "a") as out:
+            for chunk in iter(lambda: os.read(msrsync_stdout.fileno(), 65536), ''):
+                out.write(chunk)
+                out.flush()
+                lines = re.split('[\r\n]', pending + chunk)
+                pending = lines.pop()
+                for line in lines:
+                    progress = MSRSYNC_PROGRESS_PATTERN.search(line)
+                    if progress is not None:
+                        self.telemetry.set_progress(int(progress.group(1)), int(progress.group(2)),
+                                                    parse_human_size(progress.group(3)),
+                                                    parse_human_size(progress.group(4)))
+
+    def __sync_with_msrsync__(self, source, destination, rsync_flags):
         start_time = time.time()
         logging.info("Starting msrsync between '{}' '{}'".format(source, destination))
-        cmd = "msrsync -P -p 14 --stats --buckets logs --keep src dest --rsync '-{0}' {1} {2} >> msrsync_out.txt 2>> msrsync_err.txt".format(
-            rsync_flags, source, destination)
+        # msrsync can't be scaled while it runs, so it gets the window active when it starts
+        parallelism, bwlimit = self.schedule.current()
+        if bwlimit:
+            rsync_flags = "{} --bwlimit={}".format(rsync_flags, bwlimit)
+        cmd = "msrsync -P -p {3} --stats --buckets logs --keep src dest --rsync '-{0}' {1} {2} 2>> {4}".format(
+            rsync_flags, source, destination, parallelism, self.__output_path__("msrsync_err.txt"))
         pwd = ""
-        msrsync = subprocess.Popen('echo {} | sudo -S {}'.format(pwd, cmd), shell=True)
+        msrsync = subprocess.Popen('echo {} | sudo -S {}'.format(pwd, cmd), shell=True, stdout=subprocess.PIPE)
         logging.info(
             "Waiting for mrsync to complete sync between '{}' '{}' - Monitor mrsync_out and msrsync_err for more info".format(
                 source, destination))
+        self.__follow_msrsync_progress__(msrsync.stdout)
         msrsync.wait()  # Wait till msrsync completes migraiton
         logging.info(
             "Mrsync migration complete between '{}' '{}' - Check mrsync_out and msrsync_err for more info".format(
                 source, destination))
         end_time = time.time()
-        return self.__calculate_msrsync_timing__(start_time, end_time)
+        timing = self.__calculate_msrsync_timing__(start_time, end_time)
+        timing['errors'] = 1 if msrsync.returncode else 0
+        return timing
+
+    def __sync_planned_buckets__(self, source, destination, rsync_flags):
+        start_time = time.time()
+        plan_directory = self.__new_plan_directory__()
+        logging.info("Planning buckets for '{}' with {} walker threads".format(source, self.walk_threads))
+        manifest = FileManifest(self.manifest_path) if self.manifest_path else None
+        planner = SyncPlanner(self.walk_threads, self.bucket_count, manifest=manifest)
+        buckets = planner.plan(source, plan_directory)
+        planner.report(buckets)
+        self.telemetry.set_totals(sum(bucket.files for bucket in buckets), sum(bucket.size for bucket in buckets))
+
+        logging.info("Starting up to {} rsync workers for {} buckets between '{}' '{}'".format(
+            self.schedule.max_parallelism(), len(buckets), source, destination))
+        pool = ThreadPool(self.schedule.max_parallelism())
+        return_codes = pool.map(lambda bucket: self.__rsync_bucket__(bucket, source, destination, rsync_flags),
+                                buckets, chunksize=1)
+        pool.close()
+        pool.join()
+        failed_buckets = [bucket.index for bucket, return_code in zip(buckets, return_codes)
+                          if return_code not in (0, None)]
+        skipped_buckets = sum(1 for return_code in return_codes if return_code is None)
+        if failed_buckets:
+            logging.warning("rsync reported errors for buckets {} - check the bucket logs in {}".format(
+                failed_buckets, plan_directory))
+        if skipped_buckets:
+            logging.warning("Sync paused - {} buckets were not started".format(skipped_buckets))
+        if manifest is not None:
+            if failed_buckets or skipped_buckets:
+                logging.warning("Manifest not updated, the changed directories are diffed again on the next run")
+                manifest.discard()
+            else:
+                manifest.commit(source)
+            manifest.close()
+        logging.info("Planned sync complete between '{}' '{}'".format(source, destination))
+        end_time = time.time()
+        timing = self.__calculate_msrsync_timing__(start_time, end_time)
+        timing['errors'] = len(failed_buckets)
+        timing['paused'] = skipped_buckets > 0
+        return timing
+
+    def __copy_worker__(self, copies, failed_files, paused):
+        while True:
+            copy = copies.get()
+            if copy is None:
+                return
+            source_path, destination_path = copy
+            if self.pause_check():
+                paused.set()
+                continue
+            bwlimit = self.gate.acquire(self.priority)
+            start_time = time.time()
+            try:
+                size = copy_file(source_path, destination_path)
+                self.telemetry.add(None, 1, size)
+                if bwlimit:
+                    time.sleep(max(size / (bwlimit * 1024.0) - (time.time() - start_time), 0))
+            except (OSError, IOError) as e:
+                logging.debug("Failed to copy {}: {}".format(source_path, e))
+                failed_files.append((source_path, "native: {}".format(e)))
+            finally:
+                self.gate.release()
+
+    def __sync_natively__(self, source, destination):
+        """Copy source to destination on a thread pool, skipping files whose size and mtime already match."""
+        start_time = time.time()
+        logging.info("Starting native copy with up to {} workers between '{}' '{}'".format(
+            self.schedule.max_parallelism(), source, destination))
+        manifest = FileManifest(self.manifest_path) if self.manifest_path else None
+        planner = SyncPlanner(self.walk_threads, 1, manifest=manifest)
+        copies = Queue.Queue(maxsize=self.parallelism * 100)
+        failed_files = []
+        paused = threading.Event()
+        workers = [threading.Thread(target=self.__copy_worker__, args=(copies, failed_files, paused))
+                   for _ in range(self.schedule.max_parallelism())]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        directories = []
+        planned_files = planned_bytes = skipped_files = 0
+        for relative_dir, files, subdirectories in planner.listings(source):
+            if self.pause_check():
+                logging.warning("Sync paused - stopped walking '{}'".format(source))
+                paused.set()
+                break
+            source_directory = os.path.join(source, relative_dir)
+            destination_directory = os.path.join(destination, relative_dir)
+            try:
+                if not os.path.isdir(destination_directory):
+                    os.makedirs(destination_directory)
+                existing = dict((name, (size, mtime)) for name, size, mtime, inode in
+                                list_directory(destination_directory)[0])
+            except (OSError, IOError) as e:
+                failed_files.extend((os.path.join(source_directory, name), "native: {}".format(e))
+                                    for name, size, mtime, inode in files)
+                continue
+            directories.append(relative_dir)
+            for name, size, mtime, inode in files:
+                destination_attributes = existing.get(name)
+                if destination_attributes is not None and destination_attributes[0] == size and \
+                        int(destination_attributes[1]) == int(mtime):
+                    skipped_files += 1
+                    continue
+                planned_files += 1
+                planned_bytes += size
+                copies.put((os.path.join(source_directory, name), os.path.join(destination_directory, name)))
+        self.telemetry.set_totals(planned_files, planned_bytes)
+        logging.info("Walk complete - {} files ({} bytes) to copy, {} unchanged files skipped".format(
+            planned_files, planned_bytes, skipped_files))
+        for worker in workers:
+            copies.put(None)
+        for worker in workers:
+            worker.join()
+
+        # copying files into a directory changes its mtime, so directories get theirs last, deepest first
+        for relative_dir in reversed(directories):
+            try:
+                shutil.copystat(os.path.join(source, relative_dir), os.path.join(destination, relative_dir))
+            except (OSError, IOError) as e:
+                failed_files.append((os.path.join(source, relative_dir), "native: {}".format(e)))
+
+        if failed_files:
+            failed_log_file_name = self.__output_path__("FAILED_LOGS.csv")
+            logging.warning("{} files failed to copy - see {}".format(len(failed_files), failed_log_file_name))
+            LogService().__write_new_logs_to_csv__(failed_files, failed_log_file_name)
+        if manifest is not None:
+            if failed_files or paused.is_set():
+                logging.warning("Manifest not updated, the changed directories are diffed again on the next run")
+                manifest.discard()
+            else:
+                manifest.commit(source)
+            manifest.close()
+        logging.info("Native copy complete between '{}' '{}'".format(source, destination))
+        end_time = time.time()
+        timing = self.__calculate_msrsync_timing__(start_time, end_time)
+        timing['errors'] = len(failed_files)
+        timing['paused'] = paused.is_set()
+        return timing
+
+    def __rsync_bucket__(self, bucket, source, destination, rsync_flags, extra_args=()):
+        """rsync the files of a bucket and return rsync's exit code, or None when the sync was paused."""
+        if self.pause_check():
+            return None
+        bwlimit = self.gate.acquire(self.priority)
+        try:
+            cmd = ['rsync', '-{}'.format(rsync_flags), '--from0', '--files-from={}'.format(bucket.list_path),
+                   '--log-file={}'.format(bucket.log_path), '--out-format={}'.format(RSYNC_OUT_FORMAT)] + \
+                list(extra_args) + (['--bwlimit={}'.format(bwlimit)] if bwlimit else []) + \
+                [source.rstrip('/') + '/', destination.rstrip('/') + '/']
+            logging.debug("Bucket {:04d}: {}".format(bucket.index, ' '.join(cmd)))
+            self.telemetry.bucket_started(bucket)
+            with open(self.__output_path__("msrsync_out.txt"), "a") as out, \
+                    open(self.__output_path__("msrsync_err.txt"), "a") as err:
+                rsync = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+                for line in iter(rsync.stdout.readline, ''):
+                    out.write(line)
+                    transferred = RSYNC_OUT_FORMAT_PATTERN.match(line)
+                    if transferred is not None:
+                        self.telemetry.add(bucket.index, 1, int(transferred.group(1)))
+                return_code = rsync.wait()
+        finally:
+            self.gate.release()
+        self.telemetry.bucket_finished(bucket.index, return_code)
+        logging.info("Bucket {:04d} finished with rsync exit code {}".format(bucket.index, return_code))
+        return return_code
+
+    def __list_source_and_destination__(self, destination, root, relative_dir):
+        """DirectoryWalker lister returning the files and subdirectories of a source directory and
+        {name: (inode, size, mtime)} of the same directory under destination."""
+        files, subdirectories = list_directory(os.path.join(root, relative_dir))
+        try:
+            destination_files = list_directory(os.path.join(destination, relative_dir))[0]
+        except (OSError, IOError):
+            destination_files = []
+        return files, subdirectories, dict((name, (inode, size, mtime))
+                                           for name, size, mtime, inode in destination_files)
+
+    def __checksum_pair__(self, source_path, source_checksum, destination_path, destination_checksum, results):
+        """Hash what isn't cached of a (path, attributes, digest or None) pair and queue the outcome."""
+        checksums = []
+        try:
+            digests = []
+            for path, (attributes, digest) in ((source_path, source_checksum),
+                                               (destination_path, destination_checksum)):
+                if digest is None:
+                    digest = file_checksum(path)
+                    checksums.append((path, attributes, digest))
+                digests.append(digest)
+            status = None if digests[0] == digests[1] else "CHECKSUM_MISMATCH"
+        except (OSError, IOError) as e:
+            status = "verify: {}".format(e)
+        results.put((source_path, source_checksum[0][1], status, checksums))
+
+    def __checksum_mismatches__(self, source, destination, manifest):
+        """Yield (source path, status) of every source file missing from destination or with other content."""
+        hashers = ThreadPool(self.parallelism)
+        results = Queue.Queue()
+        pending = 0
+        checksums = []
+        # the destination is listed by the walker threads too, so the walk only runs as far ahead as the hashers
+        listings = DirectoryWalker(self.walk_threads).walk(
+            source, partial(self.__list_source_and_destination__, destination))
+        try:
+            for relative_dir, (files, subdirectories, destination_files) in listings:
+                source_directory = os.path.join(source, relative_dir)
+                destination_directory = os.path.join(destination, relative_dir)
+                cached = manifest.cached_checksums(source_directory)
+                cached.update(manifest.cached_checksums(destination_directory))
+                for name, size, mtime, inode in files:
+                    source_path = os.path.abspath(os.path.join(source_directory, name))
+                    destination_path = os.path.abspath(os.path.join(destination_directory, name))
+                    destination_attributes = destination_files.get(name)
+                    if destination_attributes is None:
+                        yield source_path, "MISSING"
+                        continue
+                    if destination_attributes[1] != size:
+                        yield source_path, "SIZE_MISMATCH"
+                        continue
+                    source_checksum = ((inode, size, mtime), None)
+                    destination_checksum = (destination_attributes, None)
+                    if cached.get(source_path, (None,))[0] == source_checksum[0]:
+                        source_checksum = cached[source_path]
+                    if cached.get(destination_path, (None,))[0] == destination_checksum[0]:
+                        destination_checksum = cached[destination_path]
+                    hashers.apply_async(self.__checksum_pair__, (source_path, source_checksum, destination_path,
+                                                                 destination_checksum, results))
+                    pending += 1
+                    # don't run ahead of the hashers by more than a few thousand files
+                    while pending > self.parallelism * 1000 or not results.empty():
+                        source_path, size, status, new_checksums = results.get()
+                        pending -= 1
+                        checksums.extend(new_checksums)
+                        self.telemetry.add(None, 1, size)
+                        if status is not None:
+                            yield source_path, status
+                if len(checksums) >= 1000:
+                    manifest.save_checksums(checksums)
+                    checksums = []
+            while pending:
+                source_path, size, status, new_checksums = results.get()
+                pending -= 1
+                checksums.extend(new_checksums)
+                self.telemetry.add(None, 1, size)
+                if status is not None:
+                    yield source_path, status
+            manifest.save_checksums(checksums)
+        finally:
+            listings.close()
+            hashers.terminate()
+            hashers.join()
+
+    def verify_checksums(self, source, destination):
+        """Write every file whose destination content differs from source to FAILED_LOGS.csv, ready to remigrate."""
+        start_time = time.time()
+        logging.info("Verifying '{}' against '{}' with {} checksums on {} threads".format(
+            source, destination, FILE_HASH_ALGORITHM, self.parallelism))
+        manifest = FileManifest(self.manifest_path)
+        self.telemetry.start(source, destination)
+        try:
+            mismatches = LogService().__write_new_logs_to_csv__(
+                self.__checksum_mismatches__(source, destination, manifest),
+                self.__output_path__("FAILED_LOGS.csv"))
+        finally:
+            self.telemetry.stop()
+            manifest.close()
+        if mismatches:
+            logging.warning("{} files differ between '{}' and '{}' - run remigrate mode to re-sync them".format(
+                mismatches, source, destination))
+        else:
+            logging.info("Every file of '{}' matches '{}'".format(source, destination))
+        return mismatches
 
     def __find_source_destination_for_remigration__(self, folder, source_mount_point, destination_mount_point):
-        if destination_mount_point in folder:
+        """Return {"source": ..., "destination": ...} of a path under either mount, None for any other path."""
+        if folder.startswith(destination_mount_point.rstrip('/') + '/'):
+            source = source_mount_point.rstrip('/') + folder[len(destination_mount_point.rstrip('/')):]
+            destination = folder
+        elif destination_mount_point in folder:
             seqMatch = SequenceMatcher(None, source_mount_point, folder)
             match = seqMatch.find_longest_match(0, len(source_mount_point), 0, len(folder))
             source = folder.replace(folder[0:match.b + match.size], source_mount_point[0:match.a + match.size])
@@ -142,24 +1355,110 @@ class SyncService:
         elif source_mount_point in folder:
             source = folder
             destination = folder.replace(source_mount_point, destination_mount_point)
+        else:
+            return None
 
         return {"source": source,  "destination": destination} #adding trailing slash to source to avoid folder duplication in msrsync migration
 
+    def __remigrate_batch__(self, batch, source_mount_point, destination_mount_point, rsync_flags,
+                            extra_args=('--recursive',)):
+        """rsync a batch of (path, relative source path) targets and return [(path, status, start, end)]."""
+        bucket, targets = batch
+        start_time = time.time()
+        return_code = self.__rsync_bucket__(bucket, source_mount_point, destination_mount_point, rsync_flags,
+                                            extra_args=extra_args)
+        end_time = time.asctime(time.localtime(time.time()))
+        start_time = time.asctime(time.localtime(start_time))
+        if return_code not in (0, 23, 24):
+            # anything but a partial transfer means rsync itself failed, so nothing in the batch is trusted
+            return [(path, "RSYNC_EXIT_{}".format(return_code), start_time, end_time) for path, relative in targets]
+
+        failed_relative_paths = []
+        if return_code != 0 and os.path.exists(bucket.log_path):
+            error_filter = '|'.join(re.escape(error) for error in LogService.errors_while_migration)
+            for failed_file, error_type in parse_log_file(error_filter, bucket.log_path)[1]:
+                for mount_point in (source_mount_point, destination_mount_point):
+                    if failed_file.startswith(mount_point.rstrip('/') + '/'):
+                        relative = os.path.relpath(failed_file, mount_point)
+                        directory, name = os.path.split(relative)
+                        temp_name = RSYNC_TEMP_NAME_PATTERN.match(name)
+                        if error_type.startswith('rsync: rename') and temp_name is not None:
+                            relative = os.path.join(directory, temp_name.group(1))
+                        failed_relative_paths.append(relative)
+                        break
+        results = []
+        for path, relative in targets:
+            failed = any(failed_path == relative or relative == '.' or failed_path.startswith(relative + '/')
+                         for failed_path in failed_relative_paths)
+            results.append((path, "FAILED" if failed else "SUCCESS", start_time, end_time))
+        return results
+
+    def __plan_remigration_batches__(self, paths_to_migrate, source_mount_point):
+        # not named rfsync-*, so generate-logs never mistakes a remigration for the last sync
+        plan_directory = self.__new_plan_directory__("remigrate")
+        batches = []
+        for start in range(0, len(paths_to_migrate), self.remigrate_batch_size):
+            bucket = Bucket(len(batches), os.path.join(plan_directory, 'remigrate-{:04d}.list'.format(len(batches))))
+            targets = []
+            with open(bucket.list_path, 'wb') as bucket_list:
+                for path, is_directory in paths_to_migrate[start:start + self.remigrate_batch_size]:
+                    relative = path.lstrip('/')
+                    bucket_list.write(relative + '\0')
+                    targets.append((os.path.join(source_mount_point, relative), relative))
+                    if is_directory:
+                        bucket.directories += 1
+                    else:
+                        bucket.files += 1
+            batches.append((bucket, targets))
+        return batches
+
     def remigrate_failed_files(self, failed_log_file_abs_path, source_mount_point, destination_mount_point,
-                               rsync_flags):
+                               rsync_flags, granularity='directory', manifest_path=None, collapse_ratio=0.5):
 
         logging.info("Preparing for remigration from '{}' to '{}'".format(source_mount_point, destination_mount_point))
 
-        if os.path.exists(failed_log_file_abs_path):
-            self.__prepare_failed_log_file_for_remigration__(failed_log_file_abs_path)
-            logging.debug("Identifying folders to remigrate based on missing files list in FAILED_LOG.csv")
-            folders_to_migrate = self.__check_if_folder_needs_remigration__(failed_log_file_abs_path)
-        logging.info("Remigrating between '{}' to '{}'".format(source_mount_point, destination_mount_point))
-        for folder in folders_to_migrate:
-            source_destination_dict = self.__find_source_destination_for_remigration__(folder, source_mount_point, destination_mount_point)
-            logging.debug("Remigrating failed files between paths: {} and {}".format(source_destination_dict["source"], source_destination_dict["destination"]))
-            self.sync_files_between(source_destination_dict["source"], source_destination_dict["destination"], rsync_flags)
-        self.__validate_remigrated_files__(failed_log_file_abs_path, source_mount_point, destination_mount_point)
+        if not os.path.exists(failed_log_file_abs_path):
+            logging.error("{} not found - run generate-logs mode first".format(failed_log_file_abs_path))
+            return
+        present_counts = None
+        if manifest_path:
+            manifest = FileManifest(manifest_path)
+            present_counts = manifest.file_counts(source_mount_point)
+            manifest.close()
+        logging.debug("Identifying folders to remigrate based on missing files list in FAILED_LOG.csv")
+        paths_to_migrate, checksum_mismatches = self.__check_if_folder_needs_remigration__(
+            failed_log_file_abs_path, source_mount_point, destination_mount_point, granularity, present_counts,
+            collapse_ratio)
+        self.__prepare_failed_log_file_for_remigration__(failed_log_file_abs_path)
+        batches = self.__plan_remigration_batches__(paths_to_migrate, source_mount_point)
+        # listed directories are re-synced with everything below them
+        extra_args = ['--recursive']
+        if checksum_mismatches:
+            # their size and mtime match, so rsync's quick check would skip them
+            logging.info("{} files differ by checksum only - comparing checksums in rsync".format(
+                len(checksum_mismatches)))
+            extra_args.append('--checksum')
+        self.telemetry.start(source_mount_point, destination_mount_point)
+        logging.info("Remigrating {} paths in {} rsync batches with {} workers between '{}' to '{}'".format(
+            len(paths_to_migrate), len(batches), self.schedule.max_parallelism(), source_mount_point,
+            destination_mount_point))
+        pool = ThreadPool(self.schedule.max_parallelism())
+        failed_paths = 0
+        with open("REMIGRATION_STATUS.csv", mode="w") as status_csv:
+            status_file = csv.writer(status_csv)
+            status_file.writerow(["PATH", "STATUS", "START_TIME", "END_TIME"])
+            for results in pool.imap_unordered(lambda batch: self.__remigrate_batch__(
+                    batch, source_mount_point, destination_mount_point, rsync_flags, extra_args), batches):
+                status_file.writerows(results)
+                status_csv.flush()
+                failed_paths += sum(1 for result in results if result[1] != "SUCCESS")
+        pool.close()
+        pool.join()
+        self.telemetry.stop()
+        if failed_paths:
+            logging.warning("{} paths failed to remigrate - check REMIGRATION_STATUS.csv".format(failed_paths))
+        self.__validate_remigrated_files__(failed_log_file_abs_path, source_mount_point, destination_mount_point,
+                                           checksum_mismatches)
 
 
 class LogService:
@@ -171,17 +1470,21 @@ class LogService:
         log_directory = os.getcwd()
 
         logging.debug("Doing an os.walk in {} directory".format(log_directory))
+        temp_log_directories = []
         for path, subdirectories, files in os.walk(log_directory):
             logging.debug("Recursively checking path {} - Checking subdirectories {}".format(path, subdirectories))
             for subdir in subdirectories:
                 logging.debug("Checking Subdirectory {} for msrsync folder".format(subdir))
-                temp_log_folder_name = re.match("(msrsync\W+)", subdir)
-                if temp_log_folder_name is not None:
-                    logging.info(
-                        "Msrsync temp log directory found: {}".format(os.path.join(path, temp_log_folder_name.string)))
-                    return os.path.join(path, temp_log_folder_name.string)
-        logging.warning("Msrsync temp log directory not found")
-        return None
+                if re.match("((msrsync|rfsync)\W+)", subdir) is not None:
+                    temp_log_directories.append(os.path.join(path, subdir))
+        if not temp_log_directories:
+            logging.warning("Msrsync temp log directory not found")
+            return None
+        # every planner sync leaves a directory of its own, the failed files are those of the last one
+        temp_log_directory = max(temp_log_directories, key=os.path.getmtime)
+        logging.info("Msrsync temp log directory found: {} (newest of {})".format(temp_log_directory,
+                                                                                 len(temp_log_directories)))
+        return temp_log_directory
 
     def __search_log_files__(self, temp_log_directory, extension):
         log_files_abs_path = []
@@ -197,37 +1500,37 @@ class LogService:
         return log_files_abs_path
 
     def __parse_temp_logs__(self, log_files_abs_path):
-        failed_files_dict = {}
-
-        for log_file in log_files_abs_path:
-            logging.debug("Parsing log files {}".format(log_file))
-            with open(log_file, mode='r') as log:
-                for line in log:
-                    for error in self.errors_while_migration:
-                        if error in line:
-                            logging.debug("Failed file found: {}".format(line))
-                            match = re.match(
-                                "([0-9\/]+) ([0-9:]+) (\[[0-9]+\]) ([a-z :_]+) \"([\/A-Za-z0-9-_.]+)\"(.*)", line)
-                            print("Group" + match.group())
-                            failed_file = match.group(5)
-                            error_type = match.group(4)
-                            failed_files_dict[failed_file] = error_type
-            log.close()
-
-        return failed_files_dict
-
-    def __write_new_logs_to_csv__(self, failed_files_abs_path_from_logs):
-        failed_log_file_name = "FAILED_LOGS.csv"
+        """Yield (path, error_type) of every failed file, parsing the log files in a process pool."""
+        error_filter = '|'.join(re.escape(error) for error in self.errors_while_migration)
+        pool = Pool()
+        try:
+            for log_file, failed_files, unparsed_lines in pool.imap_unordered(
+                    partial(parse_log_file, error_filter), log_files_abs_path):
+                logging.debug("Parsed log file {} - {} failed files".format(log_file, len(failed_files)))
+                if unparsed_lines:
+                    logging.warning("Skipped {} error lines of {} that could not be parsed".format(
+                        unparsed_lines, log_file))
+                for failed_file in failed_files:
+                    yield failed_file
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __write_new_logs_to_csv__(self, failed_files_abs_path_from_logs, failed_log_file_name="FAILED_LOGS.csv"):
+        """Stream (path, error_type) records into FAILED_LOGS.csv, once per path, and return the number written."""
         logging.info("Generating CSV with failed files list: {}".format(failed_log_file_name))
 
+        written_files = set()
         with open(failed_log_file_name, mode='w') as logs_csv:
             log_file = csv.DictWriter(logs_csv, fieldnames=["FILE_NAME", "MIGRATION_STATUS"])
             log_file.writeheader()
 
-            for key, value in failed_files_abs_path_from_logs.iteritems():
-                log_file.writerow({'FILE_NAME': key, 'MIGRATION_STATUS': value})
+            for failed_file, error_type in failed_files_abs_path_from_logs:
+                if failed_file not in written_files:
+                    written_files.add(failed_file)
+                    log_file.writerow({'FILE_NAME': failed_file, 'MIGRATION_STATUS': error_type})
 
-        return failed_log_file_name
+        return len(written_files)
 
     def delete_old_migration_logs(self):
         temp_log_directory = self.__search_for_temp_log_directory__()
@@ -270,11 +1573,11 @@ class LogService:
                 logging.info("*.log files found in temp log directory {}".format(temp_log_directory))
                 logging.info("Searching for files failed to migrate from *.log files {}".format(temp_log_directory))
                 failed_files_abs_path_from_logs = self.__parse_temp_logs__(log_files_abs_path)
+                failed_files_count = self.__write_new_logs_to_csv__(failed_files_abs_path_from_logs)
 
-                if failed_files_abs_path_from_logs:
-                    logging.info("Found failed files during migration")
-                    failed_log_file_name = self.__write_new_logs_to_csv__(failed_files_abs_path_from_logs)
-                    logging.info("Generated CSV with failed files list: {}".format(failed_log_file_name))
+                if failed_files_count:
+                    logging.info("Found {} failed files during migration".format(failed_files_count))
+                    logging.info("Generated CSV with failed files list: FAILED_LOGS.csv")
 
                 else:
                     logging.warning("No files failed during migration")
@@ -292,27 +1595,150 @@ class LogService:
         with open("timesheet.csv", mode="a") as timesheet:
             timesheet_file = csv.DictWriter(timesheet, fieldnames=["SOURCE", "DESTINATION", "START_TIME", "END_TIME",
                                                                    "TIME_TAKEN"])
-            timesheet_file.writeheader()
+            if timesheet.tell() == 0:
+                timesheet_file.writeheader()
             timesheet_file.writerow(
                 {'SOURCE': source, 'DESTINATION': destination, 'START_TIME': start_time, 'END_TIME': end_time,
                  'TIME_TAKEN': time_taken})
         logging.info("Timing logs generated, please check timesheet.csv for more details")
 
 
+def orchestrate_migrations(args, schedule):
+    """Sync every pending pair of args.pairs, args.pair_concurrency pairs at a time, sharing one worker budget."""
+    runs = RunDatabase(args.runs_db)
+    runs.load_pairs(args.pairs)
+    pairs = runs.pending_pairs()
+    schedule = schedule or SyncSchedule([], args.parallelism)
+    gate = WorkerGate(schedule)
+    logs = LogService()
+    logs.create_log_folder()
+    telemetries = []
+    if args.metrics_port:
+        # one endpoint for every pair, told apart by their source and destination labels
+        serve_metrics(args.metrics_port, lambda: prometheus_text(
+            [sample for telemetry in list(telemetries) for sample in telemetry.metric_samples()]))
+    logging.info("Orchestrating {} pending pairs, {} at a time, sharing up to {} workers".format(
+        len(pairs), args.pair_concurrency, schedule.max_parallelism()))
+
+    def run_pair(pair):
+        source, destination, priority = pair
+        if runs.status(source, destination) != 'PENDING':
+            logging.info("Skipping '{}' '{}' - it is no longer pending".format(source, destination))
+            return
+        logging.info("Starting pair '{}' '{}' with priority {}".format(source, destination, priority))
+        runs.start(source, destination)
+        # every pair keeps its FAILED_LOGS.csv and rsync output apart, remigrate it from inside that directory
+        output_directory = os.path.join(os.getcwd(), "pairs",
+                                        re.sub(r'[^A-Za-z0-9]+', '_', "{}-{}".format(source, destination)).strip('_'))
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+        telemetry = SyncTelemetry(os.path.join(output_directory, os.path.basename(args.status_file)),
+                                  args.status_interval, labels={'source': source, 'destination': destination})
+        telemetries.append(telemetry)
+        sync = SyncService(args.engine, args.parallelism, args.walk_threads, args.buckets,
+                           args.manifest if args.incremental else None, telemetry=telemetry, schedule=schedule,
+                           gate=gate, priority=priority, pause_check=runs.pause_check(source, destination),
+                           output_directory=output_directory)
+        try:
+            timing = sync.sync_files_between(source, destination, args.rsync_flags)
+        except Exception:
+            logging.exception("Pair '{}' '{}' failed".format(source, destination))
+            runs.finish(source, destination, 'FAILED', telemetry.bytes_done, telemetry.files_done)
+            return
+        # a pause requested after the last bucket started leaves nothing to resume
+        if timing.get('paused'):
+            status = 'PAUSED'
+        else:
+            status = 'FAILED' if timing.get('errors') else 'DONE'
+        runs.finish(source, destination, status, telemetry.bytes_done, telemetry.files_done)
+        logs.generate_timing_logs(source=source, destination=destination, start_time=timing['start_time'],
+                                  end_time=timing['end_time'], time_taken=timing['time_taken'])
+        logging.info("Pair '{}' '{}' {} - {} files, {} bytes".format(
+            source, destination, status, telemetry.files_done, telemetry.bytes_done))
+
+    # pairs are handed out in priority order, and the shared gate gives free workers to the best priority first
+    pool = ThreadPool(args.pair_concurrency)
+    pool.map(run_pair, pairs, chunksize=1)
+    pool.close()
+    pool.join()
+    for status, count, transferred_bytes, transferred_files in runs.summary():
+        logging.info("{} pairs {} - {} files, {} bytes".format(count, status, transferred_files or 0,
+                                                               transferred_bytes or 0))
+    runs.close()
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--mode', choices=['sync', 'remigrate', 'generate-logs'],
+    parser.add_argument('--mode', choices=['sync', 'remigrate', 'generate-logs', 'verify', 'orchestrate', 'pause',
+                                           'resume'],
                         help="1. Use 'sync' mode with source, destination and rsync flags to run a normal rsync. \n "
                              "2. Use 'remigrate' mode with absolute path to 'FAILED_LOGS.csv' to run the script in re-migration mode \n"
-                             "3. Use 'generate-logs' mode  run the script to only generate a list of failed files from previous migration. This mode fails if 'logs' directory has been cleared",
+                             "3. Use 'generate-logs' mode  run the script to only generate a list of failed files from previous migration. This mode fails if 'logs' directory has been cleared \n"
+                             "4. Use 'verify' mode to compare checksums of every source file with the destination and write the differences to 'FAILED_LOGS.csv' \n"
+                             "5. Use 'orchestrate' mode with --pairs to sync every mount pair of a CSV, 'pause' and 'resume' with source and destination to pause or resume one of its pairs",
                         required=True)
-    parser.add_argument('--source', help='Specify the source folder to be migrated', required=True)
-    parser.add_argument('--destination', help='Specify the destination folder here to be migrated', required=True)
-    parser.add_argument('--rsync_flags', help="Specify flags for msrsync's rsync workers", required=True)
+    parser.add_argument('--source', help='Specify the source folder to be migrated')
+    parser.add_argument('--destination', help='Specify the destination folder here to be migrated')
+    parser.add_argument('--pairs', help="CSV with SOURCE, DESTINATION and PRIORITY (lowest first) columns of the "
+                                        "mount pairs synced in 'orchestrate' mode")
+    parser.add_argument('--runs_db', default='rfsync_runs.db',
+                        help="SQLite database of the pairs of 'orchestrate' mode, default is rfsync_runs.db")
+    parser.add_argument('--pair_concurrency', type=int, default=2,
+                        help="Number of pairs synced at once in 'orchestrate' mode, default is 2")
+    parser.add_argument('--rsync_flags', help="Specify flags for msrsync's rsync workers")
+    parser.add_argument('--engine', choices=['msrsync', 'planner', 'native'], default='msrsync',
+                        help="'msrsync' hands the whole source to msrsync, 'planner' walks the source in parallel, "
+                             "splits it into buckets balanced by size and file count and runs rsync per bucket, "
+                             "'native' copies the files itself on --parallelism threads (rsync_flags are ignored)")
+    parser.add_argument('--parallelism', type=int, default=14, help="Number of rsync workers, default is 14")
+    parser.add_argument('--walk_threads', type=int, default=16,
+                        help="Number of threads listing the source directories in 'planner' engine, default is 16")
+    parser.add_argument('--buckets', type=int,
+                        help="Number of buckets planned by the 'planner' engine, default is 4 x parallelism")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only sync directories whose mtime changed since the last successful 'planner' run, "
+                             "as recorded in the manifest")
+    parser.add_argument('--manifest', default='rfsync_manifest.db',
+                        help="SQLite manifest used by --incremental and to cache the checksums of 'verify' mode, "
+                             "default is rfsync_manifest.db")
+    parser.add_argument('--granularity', choices=['directory', 'file', 'auto'], default='directory',
+                        help="How 'remigrate' mode re-syncs failed files: their whole 'directory', every 'file' on "
+                             "its own, or 'auto' to re-sync a directory once --collapse_ratio of the files below it "
+                             "failed (needs the manifest), default is directory")
+    parser.add_argument('--collapse_ratio', type=float, default=0.5,
+                        help="Share of failed files that makes 'auto' granularity re-sync a whole directory")
+    parser.add_argument('--remigrate_batch_size', type=int, default=500,
+                        help="Number of failed folders or files re-synced by one rsync in 'remigrate' mode, "
+                             "batches run on --parallelism workers, default is 500")
+    parser.add_argument('--validate_with', choices=['exists', 'attributes', 'checksum'], default='exists',
+                        help="How 'remigrate' mode validates re-synced files: they 'exist' at the destination, "
+                             "also match the source's size and mtime ('attributes') or its 'checksum'")
+    parser.add_argument('--schedule',
+                        help="JSON file of time-of-day windows with the parallelism and per worker --bwlimit (KB/s) "
+                             "allowed in each, outside them --parallelism workers run without a limit")
+    parser.add_argument('--status_file', default='rfsync_status.json',
+                        help="JSON file with the live throughput, ETA and bucket progress, default is "
+                             "rfsync_status.json")
+    parser.add_argument('--status_interval', type=int, default=10,
+                        help="Seconds between updates of --status_file, default is 10")
+    parser.add_argument('--metrics_port', type=int,
+                        help="Serve the live progress as Prometheus metrics on this port")
     parser.add_argument('--logging_level', choices=['debug', 'info'],
                         help="Specify the logging level and monitor rfsync.log file, default is INFO", default="info",
                         required=False)
     args = parser.parse_args()
+    if args.mode == 'orchestrate':
+        if args.pairs is None:
+            parser.error("--pairs is required in 'orchestrate' mode")
+    elif args.source is None or args.destination is None:
+        parser.error("--source and --destination are required in '{}' mode".format(args.mode))
+    if args.mode in ('sync', 'remigrate', 'orchestrate') and args.rsync_flags is None and args.engine != 'native':
+        parser.error("--rsync_flags is required in '{}' mode".format(args.mode))
+    if args.mode == 'orchestrate' and args.engine == 'msrsync':
+        # msrsync runs its own workers, so concurrent pairs would each take the whole --parallelism budget
+        parser.error("'orchestrate' mode shares one worker budget between pairs, use --engine planner or native")
+    if args.incremental and args.engine == 'msrsync':
+        parser.error("--incremental needs an engine that plans its own file lists, e.g. --engine planner")
 
     # set logging level
     if args.logging_level == 'debug':
@@ -322,11 +1748,17 @@ def main():
         logging.basicConfig(level=logging.INFO, filename='rfsync.log', filemode='a',
                             format='%(levelname)s - %(asctime)s - %(message)s', datefmt='%d-%b-%y %H:%M')
 
+    schedule = SyncSchedule.load(args.schedule, args.parallelism) if args.schedule else None
+    telemetry = SyncTelemetry(args.status_file, args.status_interval)
+    if args.metrics_port and args.mode != 'orchestrate':
+        telemetry.serve(args.metrics_port)
+
     # select mode
     if args.mode == 'sync':
         logging.info("Running script in sync mode. File sync between Source: {} - Destination: {}".format(args.source,
                                                                                                           args.destination))
-        sync = SyncService()
+        sync = SyncService(args.engine, args.parallelism, args.walk_threads, args.buckets,
+                           args.manifest if args.incremental else None, telemetry=telemetry, schedule=schedule)
         logs = LogService()
 
         logs.create_log_folder()
@@ -337,7 +1769,9 @@ def main():
         logs.generate_timing_logs(source=args.source, destination=args.destination, start_time=msrsync['start_time'],
                                   end_time=msrsync['end_time'], time_taken=msrsync['time_taken'])
     elif args.mode == 'remigrate':
-        sync = SyncService()
+        sync = SyncService(args.engine, args.parallelism, args.walk_threads, args.buckets,
+                           remigrate_batch_size=args.remigrate_batch_size, validate_with=args.validate_with,
+                           telemetry=telemetry, schedule=schedule)
         logs = LogService()
 
         logging.info("Creating log directory: '{}' for dumping msrsync temp log files".format(os.getcwd() + "/logs"))
@@ -348,7 +1782,10 @@ def main():
 
         sync.remigrate_failed_files(failed_log_file_abs_path="{}/FAILED_LOGS.csv".format(os.getcwd()),
                                     source_mount_point=args.source,
-                                    destination_mount_point=args.destination, rsync_flags=args.rsync_flags)
+                                    destination_mount_point=args.destination, rsync_flags=args.rsync_flags,
+                                    granularity=args.granularity,
+                                    manifest_path=args.manifest if os.path.exists(args.manifest) else None,
+                                    collapse_ratio=args.collapse_ratio)
         logging.info("Remigration complete - check FAILED_LOGS.csv for migration status")
 
 
@@ -358,6 +1795,28 @@ def main():
         logs = LogService()
         logs.generate_failed_files_logs()
 
+    elif args.mode == 'verify':
+        logging.info("Running script in verify mode. NOTE: This mode doesn't migrate any files")
+
+        sync = SyncService(args.engine, args.parallelism, args.walk_threads, manifest_path=args.manifest,
+                           telemetry=telemetry)
+        sync.verify_checksums(args.source, args.destination)
+        logging.info("Verification complete - check FAILED_LOGS.csv for files to remigrate")
+
+    elif args.mode == 'orchestrate':
+        logging.info("Running script in orchestrate mode for the pairs in {}".format(args.pairs))
+        orchestrate_migrations(args, schedule)
+        logging.info("Orchestration complete - check {} for the status of every pair".format(args.runs_db))
+
+    elif args.mode in ('pause', 'resume'):
+        runs = RunDatabase(args.runs_db)
+        status = 'PAUSED' if args.mode == 'pause' else 'PENDING'
+        if runs.set_status(args.source, args.destination, status):
+            logging.info("Pair '{}' '{}' set to {}".format(args.source, args.destination, status))
+        else:
+            logging.error("Pair '{}' '{}' not found in {}".format(args.source, args.destination, args.runs_db))
+        runs.close()
+
 
 if __name__ == "__main__":
     main()
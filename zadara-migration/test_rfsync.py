@@ -0,0 +1,81 @@
+"""Unit tests of the pieces of rfsync.py that don't touch rsync or the mounts.
+
+Run: python -m unittest test_rfsync
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from rfsync import FailedPathTrie, SyncService
+
+
+class FailedPathTrieTest(unittest.TestCase):
+
+    def trie(self, paths, keep_files=True):
+        failed_paths = FailedPathTrie(keep_files=keep_files)
+        for path in paths:
+            failed_paths.add(path)
+        return failed_paths
+
+    def test_directory_granularity_collapses_files_to_their_directory(self):
+        failed_paths = self.trie(['/a/b/1.txt', '/a/b/2.txt', '/a/c.txt'], keep_files=False)
+        self.assertEqual(sorted(failed_paths.targets('directory')), [('/a', True)])
+
+    def test_directory_granularity_keeps_files_below_the_root(self):
+        failed_paths = self.trie(['/top.txt', '/a/d.txt'], keep_files=False)
+        self.assertEqual(sorted(failed_paths.targets('directory')), [('/a', True), ('/top.txt', False)])
+        self.assertEqual(sum(failed_paths.failed), 2)
+
+    def test_file_granularity_lists_every_failed_file_once(self):
+        failed_paths = self.trie(['/top.txt', '/a/d.txt', '/a/d.txt', '/a/b/e.txt'])
+        self.assertEqual(sorted(failed_paths.targets('file')),
+                         [('/a/b/e.txt', False), ('/a/d.txt', False), ('/top.txt', False)])
+
+    def test_auto_granularity_collapses_directories_by_collapse_ratio(self):
+        failed_paths = self.trie(['/a/1.txt', '/a/2.txt', '/b/1.txt', '/top.txt'])
+        present_counts = {'/': 13, '/a': 2, '/b': 10}
+        self.assertEqual(sorted(failed_paths.targets('auto', present_counts, 0.5)),
+                         [('/a', True), ('/b/1.txt', False), ('/top.txt', False)])
+
+    def test_auto_granularity_collapses_directories_missing_from_present_counts(self):
+        failed_paths = self.trie(['/a/1.txt', '/top.txt'])
+        self.assertEqual(sorted(failed_paths.targets('auto', {}, 0.5)), [('/a', True), ('/top.txt', False)])
+
+    def test_failed_rename_is_added_under_its_final_name(self):
+        failed_paths = FailedPathTrie()
+        failed_paths.add('/a/.f.txt.AbC123', renamed=True)
+        failed_paths.add('/a/.g.txt.AbC123')
+        self.assertEqual(sorted(failed_paths.targets('file')), [('/a/.g.txt.AbC123', False), ('/a/f.txt', False)])
+
+
+class RemigrationPathsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.failed_log = os.path.join(self.directory, 'FAILED_LOGS.csv')
+        self.sync = SyncService()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_failed_log(self, rows):
+        with open(self.failed_log, 'w') as failed_log:
+            failed_log.write('FILE_NAME,MIGRATION_STATUS\n')
+            failed_log.writelines('{},{}\n'.format(path, status) for path, status in rows)
+
+    def test_paths_under_neither_mount_are_not_mapped(self):
+        self.assertIsNone(self.sync.__find_source_destination_for_remigration__('/other/a/f.txt', '/src', '/dst'))
+        self.assertEqual(self.sync.__find_source_destination_for_remigration__('/dst/a/f.txt', '/src', '/dst'),
+                         {'source': '/src/a/f.txt', 'destination': '/dst/a/f.txt'})
+
+    def test_failed_paths_of_both_mounts_collapse_below_the_source_mount(self):
+        self.write_failed_log([('/src/a/f.txt', 'rsync: link_stat'), ('/dst/a/.g.txt.AbC123', 'rsync: rename'),
+                               ('/other/h.txt', 'file has vanished:'), ('/src/top.txt', 'CHECKSUM_MISMATCH')])
+        paths_to_sync, checksum_mismatches = self.sync.__check_if_folder_needs_remigration__(
+            self.failed_log, '/src', '/dst', 'file', None, 0.5)
+        self.assertEqual(sorted(paths_to_sync), [('/a/f.txt', False), ('/a/g.txt', False), ('/top.txt', False)])
+        self.assertEqual(checksum_mismatches, set(['/src/top.txt']))
+
+
+if __name__ == '__main__':
+    unittest.main()